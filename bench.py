@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Benchmark the csv2png stages against a local stand-in for the GitHub markdown API.
+
+    python3 bench.py run -o results.json --latency 0.05
+    python3 bench.py compare baseline.json results.json
+    python3 bench.py formatters --rows 100000
+    python3 bench.py batch --tables 200
+    python3 bench.py sheet --tables 100
+"""
+import sys
+import json
+import multiprocessing
+import time
+import random
+import string
+import argparse
+import platform
+import resource
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import d2_png
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers POST /markdown like GitHub does for pipe tables and paragraphs,
+    after `latency` seconds, and 413 for texts above `max_bytes`
+    """
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.latency)
+        self.server.calls += 1
+        if self.server.max_bytes and len(payload["text"].encode("utf8")) > self.server.max_bytes:
+            self.send_response(413)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        blocks = []
+        for block in payload["text"].split("\n\n"):
+            lines = [l.strip().strip("|").split("|") for l in block.strip().splitlines() if l.startswith("|")]
+            if not lines:
+                if block.strip():
+                    blocks.append(f"<p>{block.strip()}</p>")
+                continue
+            rows = [lines[0]] + lines[2:]
+            blocks.append("<table>\n" + "\n".join(
+                "<tr>" + "".join(f"<td>{c.strip()}</td>" for c in cells) + "</tr>" for cells in rows
+            ) + "\n</table>")
+        body = ("\n".join(blocks) + "\n").encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(latency, max_bytes=None):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.latency = latency
+    server.max_bytes = max_bytes
+    server.calls = 0
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def dataset(rows, cols, width, seed=0):
+    rnd = random.Random(seed)
+    names = [f"col{i}" for i in range(cols)]
+    alphabet = string.ascii_letters + string.digits
+    return [
+        {name: "".join(rnd.choices(alphabet, k=width)) for name in names}
+        for _ in range(rows)
+    ]
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples):
+    return {
+        "p50": percentile(samples, 50),
+        "p99": percentile(samples, 99),
+        "mean": sum(samples) / len(samples),
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_case(data, repeat, raster):
+    stages = {"table_markdown": [], "table_html": [], "post_github": [], "render_page": [], "rasterize": []}
+    totals = []
+    for _ in range(repeat):
+        t_md, md = timed(d2_png.table_markdown, data)
+        t_local, _ = timed(d2_png.table_html, data)
+        t_api, html = timed(d2_png.post_github, md, "markdown", None)
+        t_page, page = timed(d2_png.render_page, html)
+        stages["table_markdown"].append(t_md)
+        stages["table_html"].append(t_local)
+        stages["post_github"].append(t_api)
+        stages["render_page"].append(t_page)
+        total = t_md + t_api + t_page
+        if raster:
+            t_img, _ = timed(d2_png.rasterize, page)
+            stages["rasterize"].append(t_img)
+            total += t_img
+        totals.append(total)
+    return {
+        "stages": {name: summarize(s) for name, s in stages.items() if s},
+        "total": summarize(totals),
+        "throughput": len(totals) / sum(totals),
+    }
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss * scale
+
+
+def run_case(api, rows, cols, width, repeat, raster):
+    """One grid case in a fresh process, so the peaks are its own"""
+    d2_png.GITHUB_MARKDOWN_API = api
+    case = bench_case(dataset(rows, cols, width), repeat, raster)
+    # wkhtmltoimage runs as children, their peak is where rasterization memory goes
+    case.update(peak_rss=peak_rss(), peak_rss_children=peak_rss(resource.RUSAGE_CHILDREN))
+    return case
+
+
+def parse_grid(value):
+    return [int(v) for v in value.split(",")]
+
+
+def cmd_run(args):
+    stub = start_stub(args.latency)
+    d2_png.GITHUB_MARKDOWN_API = f"http://127.0.0.1:{stub.server_port}/markdown"
+    raster = not args.no_raster
+    if raster:
+        try:
+            d2_png.wkhtmltoimage_command()
+        except OSError:
+            print("wkhtmltoimage not found, skipping the rasterize stage", file=sys.stderr)
+            raster = False
+
+    results = []
+    api = d2_png.GITHUB_MARKDOWN_API
+    ctx = multiprocessing.get_context("spawn")
+    for rows in parse_grid(args.rows):
+        for cols in parse_grid(args.cols):
+            for width in parse_grid(args.width):
+                with ctx.Pool(1) as pool:
+                    case = pool.apply(run_case, (api, rows, cols, width, args.repeat, raster))
+                case.update(rows=rows, cols=cols, width=width)
+                results.append(case)
+                print(
+                    f"{rows:>7} x {cols:<3} w{width:<3} "
+                    + " ".join(f"{k}={v['p50'] * 1000:.2f}ms" for k, v in case["stages"].items())
+                    + f" {case['throughput']:.1f}/s",
+                    file=sys.stderr,
+                )
+    stub.shutdown()
+
+    report = {
+        "version": d2_png.version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": args.latency,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+def legacy_markdown(data, title=""):
+    """The printable.readable + pipe-join formatter table_markdown replaced"""
+    from printable import readable
+
+    md = readable(list(data), grid='markdown')
+    md = '\n'.join(['|' + l + '|' for l in md.split('\n')])
+    return f"{title}\n\n{md}" if title else md
+
+
+def measure(fn, data):
+    """Wall time of one call, then the peak traced allocation of another (tracing slows it down)"""
+    seconds, out = timed(fn, data)
+    size = len(out)
+    del out
+    tracemalloc.start()
+    try:
+        fn(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, size
+
+
+def cmd_formatters(args):
+    data = dataset(args.rows, args.cols, args.width)
+    formatters = {"table_markdown": d2_png.table_markdown, "table_html": d2_png.table_html}
+    try:
+        import printable  # noqa: F401
+        formatters["legacy_markdown"] = legacy_markdown
+    except ImportError:
+        print("printable not installed, skipping the legacy formatter", file=sys.stderr)
+
+    for name, fn in formatters.items():
+        seconds, peak, size = measure(fn, data)
+        print(f"{name:<16} {seconds:8.2f}s peak {peak / 2**20:8.1f}MB output {size / 2**20:8.1f}MB")
+    return 0
+
+
+def cmd_batch(args):
+    stub = start_stub(args.latency, args.max_payload)
+    d2_png.GITHUB_MARKDOWN_API = f"http://127.0.0.1:{stub.server_port}/markdown"
+    texts = [
+        d2_png.table_markdown(dataset(args.rows, args.cols, args.width, seed=i), f"table {i}")
+        for i in range(args.tables)
+    ]
+    seconds, one_by_one = timed(lambda: [d2_png.post_github(t, "markdown", None) for t in texts])
+    calls, stub.calls = stub.calls, 0
+    print(f"post_github x{len(texts):<5} {seconds:8.2f}s {calls:6} calls", file=sys.stderr)
+    seconds, batched = timed(d2_png.post_github_many, texts, max_bytes=args.max_bytes)
+    print(f"post_github_many   {seconds:8.2f}s {stub.calls:6} calls", file=sys.stderr)
+    stub.shutdown()
+    same = [a.strip() for a in one_by_one] == [b.strip() for b in batched]
+    print("fragments match" if same else "FRAGMENTS DIFFER", file=sys.stderr)
+    return 0 if same else 1
+
+
+def cmd_sheet(args):
+    try:
+        d2_png.wkhtmltoimage_command()
+    except OSError:
+        print("wkhtmltoimage not found", file=sys.stderr)
+        return 1
+    tables = [dataset(args.rows, args.cols, args.width, seed=i) for i in range(args.tables)]
+    seconds, _ = timed(lambda: [d2_png.csv2png_bytes(t) for t in tables])
+    print(f"csv2png x{len(tables):<5} {seconds:8.2f}s {seconds / len(tables) * 1000:8.1f}ms/table", file=sys.stderr)
+    seconds, results = timed(d2_png.csv2png_sheet, [{"data": t} for t in tables], per_sheet=args.per_sheet)
+    print(f"csv2png_sheet    {seconds:8.2f}s {seconds / len(tables) * 1000:8.1f}ms/table", file=sys.stderr)
+    failed = [r for r in results if r.error]
+    if failed:
+        print(f"{len(failed)} tables failed: {failed[0].error}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def cmd_compare(args):
+    with open(args.baseline) as f:
+        old = {(r["rows"], r["cols"], r["width"]): r for r in json.load(f)["results"]}
+    with open(args.current) as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    for case in new:
+        key = (case["rows"], case["cols"], case["width"])
+        if key not in old:
+            continue
+        for stage, stats in case["stages"].items():
+            before = old[key]["stages"].get(stage)
+            if not before or not before["p50"]:
+                continue
+            change = stats["p50"] / before["p50"] - 1
+            flag = ""
+            if change > args.threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"{key} {stage:<12} {before['p50'] * 1000:9.2f}ms -> {stats['p50'] * 1000:9.2f}ms {change:+.0%}{flag}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="run the benchmark grid")
+    p.add_argument("--rows", default="10,100,1000", help="comma separated row counts")
+    p.add_argument("--cols", default="3,10", help="comma separated column counts")
+    p.add_argument("--width", default="8,32", help="comma separated cell widths")
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--latency", type=float, default=0.0, help="stub API latency in seconds")
+    p.add_argument("--no-raster", action="store_true", help="skip wkhtmltoimage")
+    p.add_argument("-o", "--output", help="write the JSON results here")
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("formatters", help="time the formatters on one large table")
+    p.add_argument("--rows", type=int, default=100000)
+    p.add_argument("--cols", type=int, default=10)
+    p.add_argument("--width", type=int, default=16)
+    p.set_defaults(func=cmd_formatters)
+
+    p = sub.add_parser("batch", help="GitHub calls for many small tables, one by one and multiplexed")
+    p.add_argument("--tables", type=int, default=200)
+    p.add_argument("--rows", type=int, default=10)
+    p.add_argument("--cols", type=int, default=4)
+    p.add_argument("--width", type=int, default=8)
+    p.add_argument("--latency", type=float, default=0.05, help="stub API latency in seconds")
+    p.add_argument("--max-payload", type=int, help="stub answers 413 above this many bytes of text")
+    p.add_argument("--max-bytes", type=int, help="initial batch size for post_github_many")
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("sheet", help="small tables one wkhtmltoimage run each, and cut from sheets")
+    p.add_argument("--tables", type=int, default=100)
+    p.add_argument("--rows", type=int, default=5)
+    p.add_argument("--cols", type=int, default=3)
+    p.add_argument("--width", type=int, default=8)
+    p.add_argument("--per-sheet", type=int, default=50)
+    p.set_defaults(func=cmd_sheet)
+
+    p = sub.add_parser("compare", help="compare two result files")
+    p.add_argument("baseline")
+    p.add_argument("current")
+    p.add_argument("--threshold", type=float, default=0.1, help="allowed p50 slowdown")
+    p.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
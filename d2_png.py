@@ -1,19 +1,129 @@
 #!/usr/bin/env python3
 """
-pip3 install imgkit requests printable
+pip3 install imgkit requests
 """
 import os, sys
+import io
+import re
+import csv
 import json
-
-import imgkit
-import requests
-from printable import readable
+import glob
+import shutil
+import signal
+import argparse
+import subprocess
+import socket
+import importlib
+import contextvars
+import time
+import base64
+import hashlib
+import tempfile
+import queue
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from functools import partial, lru_cache
+from itertools import chain, islice
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 version = "0.4"
 
+# the /markdown endpoint refuses bodies above 400 KB
+GITHUB_MARKDOWN_LIMIT = 400 * 1024
+GITHUB_MARKDOWN_API = "https://api.github.com/markdown"
+THEME_CACHE = os.getenv("D2PNG_CACHE") or os.path.join(
+    os.path.expanduser("~"), ".cache", "d2_png"
+)
+
+
+class HttpClient:
+    """
+    Keep-alive requests.Session with a bounded connection pool,
+    (connect, read) timeouts and retry with backoff on 5xx and connection errors.
+    """
 
-def http_post_json(url, data=None, is_json=True, encoding="utf8"):
-    res = requests.post(url, data=data)
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=30, retries=3, backoff=0.5):
+        from urllib3.util.retry import Retry
+
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=self.RETRY_STATUS,
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        self.session = self._session(pool_size, retry)
+        # no urllib3 retries, post() retries itself within a deadline
+        self._single = self._session(pool_size, 0)
+
+    @staticmethod
+    def _session(pool_size, retries):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def post(self, url, deadline=None, **kwargs):
+        """
+        POST with retries. Under a `deadline` every attempt and backoff wait is
+        bounded by the time left, DeadlineExceeded rather than a late answer.
+        """
+        if deadline is None:
+            kwargs.setdefault("timeout", self.timeout)
+            return self.session.post(url, **kwargs)
+        import requests
+
+        for attempt in range(self.retries + 1):
+            left = deadline.remaining()
+            kwargs["timeout"] = self.timeout if left is None else tuple(min(t, left) for t in self.timeout)
+            try:
+                res = self._single.post(url, **kwargs)
+                if res.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                    return res
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            # same schedule as urllib3: retry at once, then backoff * 2 ** n
+            deadline.sleep(self.backoff * 2 ** (attempt - 1) if attempt else 0)
+
+    def close(self):
+        self.session.close()
+        self._single.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    """The process wide HttpClient used when none is passed"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+        return _default_client
+
+
+def http_post_json(url, data=None, is_json=True, encoding="utf8", client=None):
+    res = (client or default_client()).post(url, data=data)
     if encoding:
         res.encoding = encoding
 
@@ -22,58 +132,2713 @@ def http_post_json(url, data=None, is_json=True, encoding="utf8"):
     return err, data
 
 
-def post_github(text, mode, context):
-    """Send a POST request to GitHub via API """
+class MarkdownCache:
+    """
+    Cache of markdown -> html responses keyed by a hash of (text, mode, context).
+
+    Entries live in a bounded in-memory LRU, and optionally in `directory`
+    which may be shared by several processes. Entries expire `ttl` seconds
+    after they were written, however often they are read. Files are written
+    atomically, and the directory is trimmed to `max_bytes` (least recently
+    read first) every `max_bytes / 16` bytes written or `evict_interval` seconds.
+    """
+
+    def __init__(self, maxsize=256, directory=None, max_bytes=64 * 1024 * 1024, ttl=None, evict_interval=60):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._written = 0
+        self._swept = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(text, mode, context):
+        raw = json.dumps([text, mode, context], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".html")
+
+    def _expired(self, written, now=None):
+        return self.ttl is not None and (now or time.time()) - written > self.ttl
+
+    def _remember(self, key, value, written):
+        self._lru[key] = (value, written)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._lru:
+                value, written = self._lru[key]
+                if not self._expired(written):
+                    self._lru.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._lru[key]
+
+        found = self._read(key) if self.directory else None
+        with self._lock:
+            if found is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, *found)
+        return found[0]
+
+    def _read(self, key):
+        """(value, written) of a live entry, its access time is bumped for eviction"""
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            if self._expired(st.st_mtime):
+                os.remove(path)
+                return None
+            with open(path, encoding="utf8") as f:
+                value = f.read()
+            # the mtime stays the write time the ttl counts from
+            os.utime(path, (time.time(), st.st_mtime))
+            return value, st.st_mtime
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._remember(key, value, time.time())
+        if not self.directory:
+            return
+
+        data = value.encode("utf8")
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self._written += len(data)
+            due = self._written > self.max_bytes // 16 or time.monotonic() - self._swept > self.evict_interval
+            if due:
+                self._written = 0
+                self._swept = time.monotonic()
+        if due:
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".html"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_atime, st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, _, size, _ in entries)
+        for _, mtime, size, path in sorted(entries):
+            if not self._expired(mtime, now) and total <= self.max_bytes:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "size": len(self._lru),
+            }
+
+
+class RenderError(Exception):
+    """A csv2png stage failed, `stage` names it and the original error is the __cause__"""
+
+    def __init__(self, stage, message=""):
+        super().__init__(stage, message)
+        self.stage = stage
+        self.message = message
+
+    def __str__(self):
+        return f"{self.stage}: {self.message}" if self.message else self.stage
+
+
+class DeadlineExceeded(RenderError):
+    """The time given to the call, or to this stage, ran out"""
+
+
+class Cancelled(RenderError):
+    """The call's CancelToken was cancelled"""
+
+
+class CancelToken:
+    """
+    Aborts the calls it is passed to: they raise Cancelled as their next
+    stage starts, and the waits and wkhtmltoimage runs in progress are cut short.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                pass
+
+    def on_cancel(self, fn):
+        """Call `fn` once cancelled (right away if already), returns it for remove()"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return fn
+        fn()
+        return fn
+
+    def remove(self, fn):
+        with self._lock:
+            if fn in self._callbacks:
+                self._callbacks.remove(fn)
+
+    def wait(self, seconds):
+        return self._event.wait(seconds)
+
+
+class Deadline:
+    """
+    Time budget and CancelToken of one call, checked as each stage starts and
+    enforced by the HTTP timeouts, waits and wkhtmltoimage runs inside them.
+
+    stages: optional caps in seconds for single stages, {"post_github": 5, ...}
+    """
+
+    def __init__(self, timeout=None, cancel=None, stages=None):
+        self.expires = None if timeout is None else time.monotonic() + timeout
+        self.cancel = cancel
+        self.stages = stages or {}
+        self.last_stage = None
+        self._stack = []
+
+    @property
+    def stage(self):
+        return self._stack[-1][0] if self._stack else self.last_stage
+
+    def remaining(self, stage=None):
+        """Seconds left or None when unbounded, raises once cancelled or out of time"""
+        stage = stage or self.stage
+        if self.cancel is not None and self.cancel.cancelled:
+            raise Cancelled(stage)
+        limits = [e for e in [self.expires] + [e for _, e in self._stack] if e is not None]
+        if not limits:
+            return None
+        left = min(limits) - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceeded(stage, "out of time")
+        return left
+
+    def enter(self, stage):
+        self.remaining(stage)
+        cap = self.stages.get(stage)
+        self._stack.append((stage, None if cap is None else time.monotonic() + cap))
+        self.last_stage = stage
+
+    def leave(self):
+        self._stack.pop()
+
+    def sleep(self, seconds):
+        """time.sleep that raises instead of outliving the deadline, and wakes up on cancel"""
+        left = self.remaining()
+        if left is not None and seconds > left:
+            raise DeadlineExceeded(self.stage, f"would wait {seconds:.1f}s with {left:.1f}s left")
+        if self.cancel is not None:
+            self.cancel.wait(seconds)
+        else:
+            time.sleep(seconds)
+        self.remaining()
+
+    def on_cancel(self, fn):
+        """Register `fn` with the CancelToken, returns an undo callable"""
+        if self.cancel is None:
+            return lambda: None
+        self.cancel.on_cancel(fn)
+        return partial(self.cancel.remove, fn)
+
+
+_current_deadline = contextvars.ContextVar("d2png_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """Run the block, and the csv2png stages inside it, under `deadline`"""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def _in_deadline(deadline, fn, *args, **kwargs):
+    with deadline_scope(deadline):
+        return fn(*args, **kwargs)
+
+
+def _sleep(seconds):
+    deadline = _current_deadline.get()
+    if deadline is None:
+        time.sleep(seconds)
+    else:
+        deadline.sleep(seconds)
+
+
+class GithubApiError(RenderError):
+    """Non 200 answer from the GitHub API"""
+
+    def __init__(self, status, body=""):
+        super().__init__("post_github", f"github api error code {status}: {body}")
+        self.status = status
+        self.body = body
+
+
+class GithubRateLimiter:
+    """
+    Schedules GitHub API calls within the quota of the X-RateLimit-* headers.
+
+    Calls are paced by a token bucket refilled at the remaining quota over
+    the time left until the reset, so the quota lasts the whole window at
+    the highest rate it allows, with bursts of up to `burst` calls. When the
+    quota runs out, or GitHub answers 403/429 with Retry-After, callers wait
+    for the reset instead of failing; past `max_wait` seconds they get a
+    GithubApiError.
+
+    token: sent as a Bearer token, $GITHUB_TOKEN by default (5000 calls an
+           hour instead of 60)
+    """
+
+    def __init__(self, token=None, burst=10, max_wait=None):
+        self.token = token if token is not None else os.getenv("GITHUB_TOKEN")
+        self.burst = burst
+        self.max_wait = max_wait
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.waited = 0.0
+        self.unmetered = False
+        self._probe = None
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    def _reserve(self):
+        """Take a call from the quota, returns 0 or the seconds to wait before trying again"""
+        with self._lock:
+            now = time.time()
+            if self.reset is not None and now >= self.reset:
+                self.remaining = self.reset = None
+            if self.remaining is None:
+                # quota unknown: one call at a time until its headers tell
+                if self.unmetered or self._probe is None or now - self._probe > 5:
+                    self._probe = now
+                    return 0
+                return 0.05
+
+            if self.remaining <= 0:
+                return max(self.reset - now, 0.01)
+            rate = self.remaining / max(self.reset - now, 1.0)
+            mono = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (mono - self._refilled) * rate)
+            self._refilled = mono
+            if self._tokens < 1:
+                return (1 - self._tokens) / rate
+            self._tokens -= 1
+            self.remaining -= 1
+            return 0
+
+    def check_wait(self, seconds):
+        """Account for a wait, GithubApiError when it is longer than max_wait"""
+        if self.max_wait is not None and seconds > self.max_wait:
+            raise GithubApiError(403, f"rate limited for another {seconds:.0f}s")
+        with self._lock:
+            self.waited += seconds
+
+    def acquire(self):
+        """Block until a call may be sent, within the current deadline"""
+        while True:
+            wait = self._reserve()
+            if not wait:
+                return
+            self.check_wait(wait)
+            _sleep(wait)
+
+    async def acquire_async(self):
+        import asyncio
+
+        while True:
+            wait = self._reserve()
+            if not wait:
+                return
+            self.check_wait(wait)
+            await asyncio.sleep(wait)
+
+    def update(self, status, headers):
+        """
+        Record the quota of a response, returns the seconds to wait before
+        retrying it when it was refused for rate limiting, otherwise None
+        """
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        with self._lock:
+            self._probe = None
+            if headers.get("X-RateLimit-Limit"):
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if remaining is not None and reset is not None:
+                self.remaining = int(remaining)
+                self.reset = float(reset)
+            else:
+                self.unmetered = True
+
+        if status not in (403, 429):
+            return None
+        if headers.get("Retry-After"):
+            return float(headers["Retry-After"])
+        if remaining == "0" and reset is not None:
+            return max(float(reset) - time.time(), 0) + 1
+        return None
+
+    def failed(self):
+        """A call got no response, let the next one probe the quota"""
+        with self._lock:
+            self._probe = None
+
+    def state(self):
+        with self._lock:
+            return {
+                "authenticated": bool(self.token),
+                "limit": self.limit,
+                "remaining": self.remaining,
+                "reset": self.reset,
+                "waited": round(self.waited, 3),
+            }
+
+
+_rate_limiter = None
+
+
+def default_rate_limiter():
+    """The process wide GithubRateLimiter used when none is passed"""
+    global _rate_limiter
+    with _default_client_lock:
+        if _rate_limiter is None:
+            _rate_limiter = GithubRateLimiter()
+        return _rate_limiter
+
+
+def github_markdown_call(payload, client=None, limiter=None):
+    """POST a /markdown payload through the rate limiter, returns the html"""
+    limiter = limiter or default_rate_limiter()
+    client = client or default_client()
+    deadline = _current_deadline.get()
+    while True:
+        limiter.acquire()
+        kwargs = {}
+        if isinstance(client, HttpClient):
+            kwargs["deadline"] = deadline
+        elif deadline is not None and deadline.remaining() is not None:
+            kwargs["timeout"] = deadline.remaining()
+        try:
+            res = client.post(GITHUB_MARKDOWN_API, data=payload, headers=limiter.headers(), **kwargs)
+        except BaseException:
+            limiter.failed()
+            raise
+        res.encoding = "utf8"
+        wait = limiter.update(res.status_code, res.headers)
+        if wait is None:
+            break
+        limiter.check_wait(wait)
+        _sleep(wait)
+
+    if res.status_code != 200:
+        raise GithubApiError(res.status_code, res.text)
+    return res.text
+
+
+def github_payload(text, mode, context):
     payload = {"text": text, "mode": mode}
 
     if context != None:
         payload["context"] = context
+    return json.dumps(payload)
 
-    err, r = http_post_json(
-        "https://api.github.com/markdown",
-        data=json.dumps(payload),
-        is_json=False
-    )
-    if err:
-        print(err)
-        raise Exception(f"github api error code {err}: {r}")
+
+def post_github(text, mode, context, cache=None, client=None, limiter=None):
+    """Send a POST request to GitHub via API, raises GithubApiError"""
+    if cache is not None:
+        key = cache.key(text, mode, context)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    r = github_markdown_call(github_payload(text, mode, context), client=client, limiter=limiter)
+
+    if cache is not None:
+        cache.set(key, r)
     return r
 
 
-def csv2png(data, outfile, prefix=None, suffix=None, title=""):
-    if isinstance(data, str):
-        with open(data) as f:
-            data = json.load(f)
+def post_github_many(
+    texts, mode='markdown', context=None, cache=None, client=None, max_bytes=None, limiter=None
+):
+    """
+    Render many markdown documents with as few /markdown calls as possible,
+    returns their html in order.
+
+    Documents are joined with unique marker paragraphs and the html is split
+    back on them. Batches hold up to `max_bytes` of payload; when GitHub
+    answers 413 or 422 the limit is halved and the batch sent again. A batch
+    whose markers do not come back intact is rendered one document at a time.
+    """
+    html = [None] * len(texts)
+    todo = deque()
+    for i, text in enumerate(texts):
+        cached = cache.get(cache.key(text, mode, context)) if cache is not None else None
+        if cached is not None:
+            html[i] = cached
+        else:
+            todo.append(i)
+
+    token = os.urandom(6).hex()
+    limit = max_bytes or GITHUB_MARKDOWN_LIMIT
+    while todo:
+        batch = [todo.popleft()]
+        size = len(github_payload(texts[batch[0]], mode, context).encode("utf8"))
+        while todo:
+            more = len(json.dumps(texts[todo[0]]).encode("utf8")) + 40
+            if size + more > limit:
+                break
+            batch.append(todo.popleft())
+            size += more
+
+        if len(batch) == 1:
+            i = batch[0]
+            html[i] = post_github(texts[i], mode, context, cache=cache, client=client, limiter=limiter)
+            continue
+
+        joined = "".join(
+            f"\n\nd2png-split-{token}-{n}\n\n{texts[i]}" if n else texts[i]
+            for n, i in enumerate(batch)
+        )
+        try:
+            r = github_markdown_call(github_payload(joined, mode, context), client=client, limiter=limiter)
+        except GithubApiError as e:
+            if e.status not in (413, 422):
+                raise
+            limit = size // 2
+            todo.extendleft(reversed(batch))
+            continue
+
+        parts = re.split(rf"<p[^>]*>\s*d2png-split-{token}-\d+\s*</p>", r)
+        if len(parts) != len(batch):
+            for i in batch:
+                html[i] = post_github(texts[i], mode, context, cache=cache, client=client, limiter=limiter)
+            continue
+        for i, part in zip(batch, parts):
+            html[i] = part.strip() + "\n"
+            if cache is not None:
+                cache.set(cache.key(texts[i], mode, context), html[i])
+    return html
+
+
+class Metrics:
+    """
+    Timings and sizes of one csv2png call.
+
+    Stage times are exclusive: time spent pulling rows ("load") or in a
+    nested stage is not counted again in the stage around it.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.values = {}
+        self._stack = []
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self._stack:
+            self._stack[-1] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            nested = self._stack.pop()
+            self.add(name, time.perf_counter() - start - nested)
+            if self._stack:
+                self._stack[-1] += nested
+
+    def time_rows(self, rows):
+        rows = iter(rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self.add("load", time.perf_counter() - start)
+                return
+            self.add("load", time.perf_counter() - start)
+            yield row
+
+    def as_dict(self):
+        return {"stages": dict(self.stages), **self.values}
+
+
+_current_metrics = contextvars.ContextVar("d2png_metrics", default=None)
+METRICS_HOOKS = []
+
+
+def add_metrics_hook(hook):
+    """Call `hook(metrics_dict)` after every csv2png call"""
+    METRICS_HOOKS.append(hook)
+    return hook
+
+
+def remove_metrics_hook(hook):
+    METRICS_HOOKS.remove(hook)
+
+
+@contextmanager
+def _stage(name):
+    """
+    Time the block as stage `name` and enforce the current deadline on it.
+    Errors other than RenderError come out as RenderError(name) from them.
+    """
+    metrics = _current_metrics.get()
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.enter(name)
+    try:
+        with metrics.stage(name) if metrics is not None else nullcontext():
+            yield
+    except RenderError as e:
+        # raised where no stage was entered, in a render worker
+        e.stage = e.stage or name
+        if deadline is not None and not isinstance(e, (DeadlineExceeded, Cancelled)):
+            try:
+                deadline.remaining(name)
+            except RenderError as timeout:
+                raise timeout from e
+        raise
+    except Exception as e:
+        if deadline is not None:
+            try:
+                deadline.remaining(name)
+            except RenderError as timeout:
+                raise timeout from e
+        raise RenderError(name, str(e) or type(e).__name__) from e
+    finally:
+        if deadline is not None:
+            deadline.leave()
+
+
+def _record(**values):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.values.update(values)
+
+
+def _emit(metrics, hooks):
+    report = metrics.as_dict()
+    for hook in hooks:
+        try:
+            hook(report)
+        except Exception as e:
+            print(f"metrics hook {hook!r} failed: {e}", file=sys.stderr)
+
+
+class PrometheusExporter:
+    """Metrics hook aggregating renders into the Prometheus text format, see render()"""
+
+    def __init__(self, prefix="d2png"):
+        self.prefix = prefix
+        self.renders = {}
+        self.stage_sum = {}
+        self.stage_count = {}
+        self.sizes = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, metrics):
+        status = "ok" if metrics.get("ok", True) else "error"
+        with self._lock:
+            self.renders[status] = self.renders.get(status, 0) + 1
+            for name, seconds in metrics["stages"].items():
+                self.stage_sum[name] = self.stage_sum.get(name, 0.0) + seconds
+                self.stage_count[name] = self.stage_count.get(name, 0) + 1
+            for key in ("rows", "columns", "html_bytes", "image_bytes"):
+                if key in metrics:
+                    self.sizes[key] = self.sizes.get(key, 0) + metrics[key]
+
+    def render(self):
+        p = self.prefix
+        with self._lock:
+            lines = [f"# TYPE {p}_renders_total counter"]
+            lines += [f'{p}_renders_total{{status="{k}"}} {v}' for k, v in sorted(self.renders.items())]
+            lines.append(f"# TYPE {p}_stage_seconds summary")
+            for name in sorted(self.stage_sum):
+                lines.append(f'{p}_stage_seconds_sum{{stage="{name}"}} {self.stage_sum[name]:.6f}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{name}"}} {self.stage_count[name]}')
+            for key, total in sorted(self.sizes.items()):
+                lines.append(f"# TYPE {p}_{key}_total counter")
+                lines.append(f"{p}_{key}_total {total}")
+        return "\n".join(lines) + "\n"
+
+
+class StatsdExporter:
+    """Metrics hook sending timings (ms) and sizes to StatsD over UDP"""
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix="d2png"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, metrics):
+        p = self.prefix
+        status = "ok" if metrics.get("ok", True) else "error"
+        lines = [f"{p}.renders.{status}:1|c"]
+        lines += [f"{p}.stage.{name}:{seconds * 1000:.3f}|ms" for name, seconds in metrics["stages"].items()]
+        lines += [
+            f"{p}.{key}:{metrics[key]}|h"
+            for key in ("rows", "columns", "html_bytes", "image_bytes")
+            if key in metrics
+        ]
+        try:
+            self.sock.sendto("\n".join(lines).encode("utf8"), self.address)
+        except OSError:
+            pass
+
+
+def _ndjson_rows(lines):
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _stream_rows(lines, kind):
+    if kind == "csv":
+        return csv.DictReader(lines)
+    if kind == "ndjson":
+        return _ndjson_rows(lines)
+    return iter(json.loads("".join(lines)))
+
+
+def _sniff(f):
+    """Guess the format of a text stream from its first line, works on pipes too"""
+    first = f.readline()
+    head = first.lstrip()
+    kind = "json" if head.startswith("[") else "ndjson" if head.startswith("{") else "csv"
+    return kind, chain([first], f)
+
+
+def _file_rows(path):
+    ext = os.path.splitext(path)[1].lower()
+    kind = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}.get(ext, "json")
+    with open(path, newline="" if kind == "csv" else None, encoding="utf8") as f:
+        if kind == "json":
+            yield from json.load(f)
+        else:
+            yield from _stream_rows(f, kind)
+
+
+def _str(value):
+    return "" if value is None else str(value)
+
+
+def _strings(values, nulls=None):
+    """str() over a whole column at C speed, "" where `nulls` (bools) is true"""
+    strings = list(map(str, values))
+    if nulls is not None:
+        strings = ["" if null else s for s, null in zip(strings, nulls)]
+    return strings
+
+
+def _numpy_strings(column):
+    import numpy
+
+    kind = column.dtype.kind
+    if kind == "O":
+        return [_str(v) for v in column.tolist()]
+    if kind in "SU":
+        return column.astype(str).tolist()
+    nulls = None
+    if kind in "fc":
+        nulls = numpy.isnan(column)
+    elif kind in "Mm":
+        nulls = numpy.isnat(column)
+    if nulls is not None and not nulls.any():
+        nulls = None
+    return _strings(column.tolist(), None if nulls is None else nulls.tolist())
+
+
+def _pandas_strings(series):
+    nulls = series.isna()
+    return _strings(series.tolist(), nulls.tolist() if nulls.any() else None)
+
+
+def _arrow_strings(column):
+    import pyarrow
+
+    values = column.to_pylist()
+    if pyarrow.types.is_floating(column.type):
+        # NaN is a value to Arrow, not a null
+        return _strings(values, [v is None or v != v for v in values])
+    return _strings(values, [v is None for v in values] if column.null_count else None)
+
+
+COLUMNAR_BLOCK = 8192
+
+
+def _columnar(data):
+    """
+    (names, size, blocks) for a pandas DataFrame, a NumPy structured array or
+    an Arrow Table/RecordBatch. `blocks` yields every COLUMNAR_BLOCK rows as
+    a list of columns converted to str in one go ("" for nulls, NaN included).
+    None for any other input, checked without importing anything.
+    """
+    module = type(data).__module__.partition(".")[0]
+    size = COLUMNAR_BLOCK
+    if module == "pandas" and hasattr(data, "columns"):
+        names = list(data.columns)
+        blocks = (
+            [_pandas_strings(series) for _, series in data.iloc[i:i + size].items()]
+            for i in range(0, len(data), size)
+        )
+    elif module == "numpy" and getattr(getattr(data, "dtype", None), "names", None):
+        names = list(data.dtype.names)
+        blocks = (
+            [_numpy_strings(data[name][i:i + size]) for name in names]
+            for i in range(0, len(data), size)
+        )
+    elif module == "pyarrow" and hasattr(data, "column_names"):
+        names = list(data.column_names)
+        blocks = (
+            [_arrow_strings(column) for column in data.slice(i, size).columns]
+            for i in range(0, len(data), size)
+        )
+    else:
+        return None
+    return names, len(data), blocks
+
+
+def iter_rows(data):
+    """
+    Iterate rows (dicts) lazily from
+
+    - a path to a .json (list of dicts), .csv or .ndjson/.jsonl file
+    - an open text file in any of those formats
+    - any iterable of dicts: list, generator, database cursor, ...
+    - a pandas DataFrame, NumPy structured array or Arrow table, cells as str
+    """
+    columnar = None if isinstance(data, (str, list)) else _columnar(data)
+    if columnar is not None:
+        names, _, blocks = columnar
+        rows = (dict(zip(names, values)) for columns in blocks for values in zip(*columns))
+    elif isinstance(data, str):
+        rows = _file_rows(data)
+    elif hasattr(data, "read"):
+        try:
+            kind, lines = _sniff(data)
+            rows = _stream_rows(lines, kind)
+        except Exception as e:
+            raise RenderError("load", str(e) or type(e).__name__) from e
+    else:
+        rows = iter(data)
+    rows = _load_rows(rows)
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        rows = _deadline_rows(rows, deadline)
+    metrics = _current_metrics.get()
+    return metrics.time_rows(rows) if metrics is not None else rows
+
+
+def _load_rows(rows):
+    """Errors reading or parsing the input come out as RenderError("load")"""
+    try:
+        yield from rows
+    except RenderError:
+        raise
+    except Exception as e:
+        raise RenderError("load", str(e) or type(e).__name__) from e
+
+
+def _deadline_rows(rows, deadline, every=4096):
+    for n, row in enumerate(rows):
+        if not n % every:
+            deadline.remaining()
+        yield row
+
+
+def table_cells(data, convert=str):
+    """
+    Consume rows once, discovering columns as they appear.
+    Returns (columns, rows) where every row is a list of converted cells.
+    """
+    columnar = _columnar(data)
+    if columnar is not None:
+        names, size, blocks = columnar
+        rows = [list(map(convert, cells)) for columns in blocks for cells in zip(*columns)]
+        _record(rows=size, columns=len(names))
+        return names, rows
+
+    columns = {}
+    rows = []
+    for row in iter_rows(data):
+        cells = [""] * len(columns)
+        for k, v in row.items():
+            i = columns.setdefault(k, len(columns))
+            if i == len(cells):
+                cells.append("")
+            cells[i] = "" if v is None else convert(v)
+        rows.append(cells)
+
+    width = len(columns)
+    for cells in rows:
+        if len(cells) < width:
+            cells.extend([""] * (width - len(cells)))
+    _record(rows=len(rows), columns=width)
+    return list(columns), rows
+
+
+def table_values(data):
+    """
+    (columns, rows) where every row iterates its cell values. One-shot inputs
+    (files, generators, cursors) go through table_cells so their dicts are
+    never held; columnar inputs are converted to str column by column and
+    never turned into dicts.
+    """
+    columnar = _columnar(data)
+    if columnar is not None:
+        names, size, blocks = columnar
+        _record(rows=size, columns=len(names))
+        return names, chain.from_iterable(zip(*columns) for columns in blocks)
+    if not isinstance(data, list):
+        return table_cells(data)
+
+    # the caller holds these dicts anyway
+    columns = list(dict.fromkeys(chain.from_iterable(data)))
+    _record(rows=len(data), columns=len(columns))
+    return columns, (map(row.get, columns) for row in data)
+
+
+def _breaks(text):
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text.replace("\n", "<br>")
 
-    md = readable(data, grid='markdown')
-    md = '\n'.join(['|' + l + '|' for l in md.split('\n')])
 
+def _cell(value):
+    if value is None:
+        return ""
+    return _breaks(escape(str(value)))
+
+
+def table_html(data, title=""):
+    """Build the same <table> markup GitHub renders, without the API"""
+    columns, rows = table_values(data)
+    out = []
     if title:
-        md = f"{title}\n\n{md}"
+        out.append(f"<p>{_cell(title)}</p>")
+    out.append("<table>\n<thead>\n<tr>")
+    out.extend(f"<th>{_cell(c)}</th>" for c in columns)
+    out.append("</tr>\n</thead>\n<tbody>")
+    for row in rows:
+        cells = "</td>\n<td>".join([_cell(c) for c in row])
+        out.append(f"<tr>\n<td>{cells}</td>\n</tr>")
+    out.append("</tbody>\n</table>")
+    return "\n".join(out) + "\n"
+
+
+def _md_cell(value):
+    if value is None:
+        return ""
+    return _breaks(str(value).replace("|", "\\|"))
+
 
-    html = post_github(md, 'markdown', None)
-    html = render_page(html, prefix=prefix, suffix=suffix)
+def table_markdown(data, title=""):
+    """
+    GitHub pipe table in a single pass over the rows. Cells are not padded,
+    GitHub ignores the alignment anyway.
+    """
+    columns, rows = table_values(data)
+    out = [f"{title}\n"] if title else []
+    if not columns:
+        return "\n".join(out)
+    out.append("| " + " | ".join(map(_md_cell, columns)) + " |")
+    out.append("|" + "---|" * len(columns))
+    separators = len(columns) - 1
+    for row in rows:
+        cells = ["" if v is None else str(v) for v in row]
+        line = " | ".join(cells)
+        if line.count("|") != separators or "\n" in line or "\r" in line:
+            line = " | ".join([_md_cell(c) for c in cells])
+        out.append(f"| {line} |")
+    return "\n".join(out)
+
+
+IMG_OPTIONS = {
+    'encoding': 'UTF-8',
+    'quiet': None,
+    'format': 'png',
+    'enable-smart-width': None,
+    'allow': THEME_CACHE,
+}
+
+
+BACKENDS = {"formatter": {}, "markdown": {}, "rasterizer": {}}
+
+
+def register_backend(kind, name, target):
+    """
+    Make `target` selectable by `name`, it is a callable or a "module:attr"
+    string imported on first use. Unknown names are also looked up in the
+    "d2_png.<kind>" entry point group.
+
+    formatter:  fn(data, title) -> html, or markdown when a markdown backend follows
+    markdown:   fn(text, cache=None, client=None) -> html
+    rasterizer: fn(html, outfile=None, options=None) -> image bytes without outfile,
+                or with `draws_rows = True`, fn(data, outfile=None, title="")
+    """
+    BACKENDS[kind][name] = target
+
+
+def get_backend(kind, name):
+    registry = BACKENDS[kind]
+    if name not in registry:
+        from importlib.metadata import entry_points
+
+        for ep in entry_points(group=f"d2_png.{kind}"):
+            if ep.name == name:
+                registry[name] = ep.load()
+                break
+        else:
+            raise ValueError(f"unknown {kind} backend: {name}")
+
+    target = registry[name]
+    if isinstance(target, str):
+        module, _, attr = target.partition(":")
+        target = registry[name] = getattr(importlib.import_module(module), attr)
+    return target
+
+
+def github_markdown(text, cache=None, client=None):
+    return post_github(text, 'markdown', None, cache=cache, client=client)
+
+
+def build_html(
+    data,
+    prefix=None,
+    suffix=None,
+    title="",
+    engine="local",
+    cache=None,
+    client=None,
+    theme="table",
+    formatter=None,
+):
+    """
+    Turn rows into the full html page that gets rasterized.
+
+    engine: "local" to use the formatter output as html, otherwise the name
+            of the markdown backend rendering it ("github")
+    formatter: formatter backend, "html" for the local engine and "markdown" otherwise
+    """
+    formatter = formatter or ("html" if engine == "local" else "markdown")
+    render_markdown = None if engine == "local" else get_backend("markdown", engine)
+    with _stage("format"):
+        html = get_backend("formatter", formatter)(data, title)
+    if render_markdown is not None:
+        with _stage("post_github" if engine == "github" else "markdown"):
+            html = render_markdown(html, cache=cache, client=client)
+
+    with _stage("render_page"):
+        html = render_page(html, prefix=prefix, suffix=suffix, theme=theme)
+    _record(html_bytes=len(html.encode("utf8")))
     if os.getenv("DEBUG"):
         print(html, file=sys.stderr)
-    imgkit.from_string(
-        html,
-        outfile,
-        options={
-            'encoding': 'UTF-8',
-            'quiet': None,
-            'format': 'png',
-            'enable-smart-width': None,
-        }
+    return html
+
+
+def rasterize(html, outfile=None, options=None):
+    """
+    Rasterize a html page to `outfile`, which may be a path or a writable
+    binary file. Without `outfile` the image bytes are returned.
+    """
+    if outfile is not None and hasattr(outfile, "write"):
+        outfile.write(rasterize(html, None, options))
+        return
+    if outfile is None:
+        return wkhtmltoimage_pipe(html, options)
+    if _current_deadline.get() is not None:
+        # imgkit cannot be timed out or killed
+        write_output(wkhtmltoimage_pipe(html, options), outfile)
+        return
+    import imgkit
+
+    imgkit.from_string(html, outfile, options=options or IMG_OPTIONS)
+
+
+def wkhtmltoimage_pipe(html, options=None):
+    """
+    Pipe html into wkhtmltoimage and read the image from its stdout, no temp
+    files. Under a deadline the process is killed when it runs out or is cancelled.
+    """
+    deadline = _current_deadline.get()
+    proc = subprocess.Popen(
+        wkhtmltoimage_command("-", options),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=deadline is not None,
     )
+    undo = deadline.on_cancel(partial(_kill_group, proc)) if deadline is not None else None
+    try:
+        stdout, stderr = proc.communicate(
+            html.encode("utf8"), timeout=deadline.remaining() if deadline is not None else None
+        )
+    except subprocess.TimeoutExpired:
+        _kill_group(proc)
+        proc.communicate()
+        deadline.remaining()
+        raise
+    except BaseException:
+        if proc.returncode is None:
+            _kill_group(proc)
+        raise
+    finally:
+        if undo is not None:
+            undo()
+    if deadline is not None:
+        deadline.remaining()
+    if proc.returncode != 0:
+        raise OSError(
+            f"wkhtmltoimage exited with code {proc.returncode}: {stderr.decode('utf8', 'replace')}"
+        )
+    return stdout
+
+
+def _kill_group(proc):
+    """Kill a process started in its own session with its children (xvfb-run wrappers and such)"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        proc.kill()
+
+
+def wkhtmltoimage_command(outfile="-", options=None):
+    """wkhtmltoimage argv reading html from stdin, `-` writes the image to stdout"""
+    binary = os.getenv("WKHTMLTOIMAGE") or shutil.which("wkhtmltoimage")
+    if not binary:
+        raise OSError("No wkhtmltoimage executable found, install wkhtmltopdf")
+
+    args = [binary]
+    for key, value in (options or IMG_OPTIONS).items():
+        args.append(key if key.startswith("--") else f"--{key}")
+        if value is not None:
+            args.append(str(value))
+    return args + ["-", outfile]
+
+
+# mirrors the table rules of the stylesheet in render_page
+PIL_STYLE = {
+    "font_size": 16,
+    "line_height": 1.6,
+    "cell_padding": (13, 6),
+    "page_padding": 6 + 1 + 15,
+    "title_margin": 16,
+    "color": "#333333",
+    "border": "#dddddd",
+    "background": "#ffffff",
+    "stripe": "#f8f8f8",
+}
+
+PIL_FONTS = [
+    ("DejaVuSans.ttf", "DejaVuSans-Bold.ttf"),
+    ("LiberationSans-Regular.ttf", "LiberationSans-Bold.ttf"),
+    ("Arial.ttf", "Arial Bold.ttf"),
+]
+
+
+@lru_cache(maxsize=None)
+def pil_fonts(size, font=None, bold_font=None):
+    """(regular, bold) fonts, `font` or $D2PNG_FONT first, then common system fonts"""
+    from PIL import ImageFont
+
+    font = font or os.getenv("D2PNG_FONT")
+    candidates = [(font, bold_font or font)] if font else PIL_FONTS
+    for regular, bold in candidates:
+        try:
+            return ImageFont.truetype(regular, size), ImageFont.truetype(bold, size)
+        except OSError:
+            continue
+    default = ImageFont.load_default(size)
+    return default, default
+
+
+class PilLayout:
+    """Column widths and row heights of a table drawn with Pillow"""
+
+    def __init__(self, columns, title="", style=None, font=None):
+        self.style = dict(PIL_STYLE, **(style or {}))
+        self.font, self.bold = pil_fonts(self.style["font_size"], font)
+        self.line_height = round(self.style["font_size"] * self.style["line_height"])
+        self.columns = [str(c) for c in columns]
+        self.title = title
+        pad_x, _ = self.style["cell_padding"]
+        self.widths = [self.text_width(c, self.bold) + 2 * pad_x for c in self.columns]
+
+    def text_width(self, text, font=None):
+        font = font or self.font
+        return max(round(font.getlength(line)) for line in text.split("\n"))
+
+    def fit(self, cells):
+        pad_x, _ = self.style["cell_padding"]
+        for i, cell in enumerate(cells):
+            self.widths[i] = max(self.widths[i], self.text_width(cell) + 2 * pad_x)
+
+    def row_height(self, cells):
+        _, pad_y = self.style["cell_padding"]
+        lines = max((cell.count("\n") + 1 for cell in cells), default=1)
+        return lines * self.line_height + 2 * pad_y
+
+    @property
+    def table_width(self):
+        return sum(self.widths) + 1
+
+    @property
+    def title_height(self):
+        if not self.title:
+            return 0
+        return self.title.count("\n") * self.line_height + self.line_height + self.style["title_margin"]
+
+    @property
+    def page_width(self):
+        width = self.table_width
+        if self.title:
+            width = max(width, self.text_width(self.title))
+        return width + 2 * self.style["page_padding"]
+
+    def draw_row(self, draw, cells, top, stripe=False, header=False):
+        """Draw one row with its top border at `top`, returns the next row's top"""
+        style = self.style
+        pad_x, pad_y = style["cell_padding"]
+        height = self.row_height(cells)
+        x = style["page_padding"]
+        fill = style["stripe"] if stripe else style["background"]
+        font = self.bold if header else self.font
+        for width, cell in zip(self.widths, cells):
+            draw.rectangle([x, top, x + width, top + height], fill=fill, outline=style["border"])
+            for n, line in enumerate(cell.split("\n")):
+                draw.text(
+                    (x + pad_x, top + pad_y + n * self.line_height + self.line_height // 2),
+                    line,
+                    font=font,
+                    fill=style["color"],
+                    anchor="lm",
+                )
+            x += width
+        return top + height
+
+
+def save_image(image, outfile=None):
+    """Save a PIL image as png to a path or binary file, or return its bytes"""
+    if outfile is not None:
+        image.save(outfile, "PNG")
+        return
+    buf = io.BytesIO()
+    image.save(buf, "PNG")
+    return buf.getvalue()
+
+
+OptimizeResult = namedtuple("OptimizeResult", "data format before after")
+
+
+def _exact_palette(image):
+    """The image as a palette image when that is lossless, otherwise None"""
+    from PIL import Image, ImageChops
+
+    if image.mode == "RGBA":
+        if image.getextrema()[3][0] < 255:
+            return None
+        image = image.convert("RGB")
+    if image.mode != "RGB":
+        return None
+    colors = image.getcolors(256)
+    if colors is None:
+        return None
+
+    # median cut keeps every color exactly when there are no more than asked for
+    quantized = image.quantize(len(colors), Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    if ImageChops.difference(quantized.convert("RGB"), image).getbbox() is not None:
+        return None
+    return quantized
+
+
+def optimize_image(data, format="png", compress_level=9, quality=85, lossless=True):
+    """
+    Recompress rendered image bytes, dropping any metadata.
 
+    png: palette encoded when the image has at most 256 colors, zlib `compress_level`
+    webp: `lossless`, or lossy at `quality`
+    jpeg: at `quality`
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    image.info = {}
+    buf = io.BytesIO()
+    format = format.lower()
+    if format == "png":
+        image = _exact_palette(image) or image
+        image.save(buf, "PNG", compress_level=compress_level)
+    elif format == "webp":
+        image.save(buf, "WEBP", lossless=lossless, quality=quality, method=6)
+    elif format in ("jpeg", "jpg"):
+        image.convert("RGB").save(buf, "JPEG", quality=quality, optimize=True)
+    else:
+        raise ValueError(f"unknown image format: {format}")
+    out = buf.getvalue()
+    return OptimizeResult(out, format, len(data), len(out))
+
+
+def write_output(data, outfile):
+    if outfile is None:
+        return
+    if hasattr(outfile, "write"):
+        outfile.write(data)
+        return
+    with open(outfile, "wb") as f:
+        f.write(data)
+
+
+def write_atomic(write, outfile):
+    """
+    Call `write(path)` with a temporary name next to a path `outfile` and rename
+    it into place on success, so a failed or killed render leaves no partial file.
+    Other outfiles are passed through.
+    """
+    if not isinstance(outfile, str):
+        return write(outfile)
+    part = _part_path(outfile)
+    try:
+        result = write(part)
+        os.replace(part, outfile)
+        return result
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+
+
+def _part_path(outfile):
+    root, ext = os.path.splitext(outfile)
+    return f"{root}.{os.urandom(4).hex()}.part{ext}"
+
+
+def render_table_pil(data, title="", style=None, font=None):
+    """Lay out and draw the table straight to a PIL image, no html involved"""
+    from PIL import Image, ImageDraw
+
+    columns, rows = table_cells(data)
+    layout = PilLayout(columns, title=title, style=style, font=font)
+    for cells in rows:
+        layout.fit(cells)
+
+    pad = layout.style["page_padding"]
+    height = (
+        layout.title_height
+        + layout.row_height(layout.columns)
+        + sum(layout.row_height(cells) for cells in rows)
+        + 1
+        + 2 * pad
+    )
+    image = Image.new("RGB", (layout.page_width, height), layout.style["background"])
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([6, 6, image.width - 7, image.height - 7], outline=layout.style["border"])
 
-def render_page(body, prefix=None, suffix=None):
-    prefix = prefix or """
-    <html>
-    <head>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
+    if title:
+        for n, line in enumerate(title.split("\n")):
+            draw.text(
+                (pad, pad + n * layout.line_height + layout.line_height // 2),
+                line,
+                font=layout.font,
+                fill=layout.style["color"],
+                anchor="lm",
+            )
+    top = layout.draw_row(draw, layout.columns, pad + layout.title_height, header=True)
+    for i, cells in enumerate(rows):
+        top = layout.draw_row(draw, cells, top, stripe=i % 2 == 1)
+    return image
+
+
+class IncrementalRenderer:
+    """
+    Redraw only the parts of a table that changed since the previous render.
+
+    Uses the Pillow backend. The column layout is fixed by the first render,
+    rows are grouped in blocks of `block_rows` and every block keeps its
+    content hash and pixel tile. Later renders redraw the changed blocks and
+    paste the others back. A new column, a wider cell or a new title falls
+    back to a full render.
+    """
+
+    def __init__(self, block_rows=32, title="", style=None, font=None):
+        self.block_rows = block_rows
+        self.title = title
+        self.style = style
+        self.font = font
+        self.layout = None
+        self.head = None
+        self.hashes = []
+        self.tiles = []
+        self.redrawn = 0
+
+    def _blocks(self, rows):
+        for start in range(0, len(rows), self.block_rows):
+            yield start, rows[start:start + self.block_rows]
+
+    @staticmethod
+    def _hash(block):
+        return hashlib.blake2b(json.dumps(block).encode("utf8"), digest_size=16).digest()
+
+    def _fits(self, block):
+        pad_x, _ = self.layout.style["cell_padding"]
+        return all(
+            self.layout.text_width(cell) + 2 * pad_x <= width
+            for cells in block
+            for width, cell in zip(self.layout.widths, cells)
+        )
+
+    def _tile(self, block, start):
+        from PIL import Image, ImageDraw
+
+        layout = self.layout
+        height = sum(layout.row_height(cells) for cells in block)
+        tile = Image.new("RGB", (layout.page_width, height), layout.style["background"])
+        draw = ImageDraw.Draw(tile)
+        top = 0
+        for n, cells in enumerate(block):
+            top = layout.draw_row(draw, cells, top, stripe=(start + n) % 2 == 1)
+        return tile
+
+    def _head(self):
+        from PIL import Image, ImageDraw
+
+        layout = self.layout
+        pad = layout.style["page_padding"]
+        height = pad + layout.title_height + layout.row_height(layout.columns)
+        head = Image.new("RGB", (layout.page_width, height), layout.style["background"])
+        draw = ImageDraw.Draw(head)
+        for n, line in enumerate(self.title.split("\n") if self.title else []):
+            draw.text(
+                (pad, pad + n * layout.line_height + layout.line_height // 2),
+                line,
+                font=layout.font,
+                fill=layout.style["color"],
+                anchor="lm",
+            )
+        layout.draw_row(draw, layout.columns, pad + layout.title_height, header=True)
+        return head
+
+    def _reset(self, columns, rows, title):
+        self.title = title
+        self.layout = PilLayout(columns, title=title, style=self.style, font=self.font)
+        for cells in rows:
+            self.layout.fit(cells)
+        self.head = self._head()
+        self.hashes = []
+        self.tiles = []
+
+    def render(self, data, outfile=None, title=None):
+        """Render `data`, save it to `outfile` when given, returns the PIL image"""
+        from PIL import Image, ImageDraw
+
+        title = self.title if title is None else title
+        columns, rows = table_cells(data)
+        full = (
+            self.layout is None
+            or title != self.title
+            or [str(c) for c in columns] != self.layout.columns
+        )
+        hashes, tiles, redrawn = [], [], 0
+        if not full:
+            for n, (start, block) in enumerate(self._blocks(rows)):
+                digest = self._hash(block)
+                if n < len(self.hashes) and self.hashes[n] == digest:
+                    tiles.append(self.tiles[n])
+                elif self._fits(block):
+                    tiles.append(self._tile(block, start))
+                    redrawn += 1
+                else:
+                    full = True
+                    break
+                hashes.append(digest)
+
+        if full:
+            self._reset(columns, rows, title)
+            hashes, tiles = [], []
+            for start, block in self._blocks(rows):
+                hashes.append(self._hash(block))
+                tiles.append(self._tile(block, start))
+            redrawn = len(tiles)
+
+        self.hashes, self.tiles, self.redrawn = hashes, tiles, redrawn
+        layout = self.layout
+        style = layout.style
+        pad = style["page_padding"]
+        body = sum(tile.height for tile in tiles)
+        image = Image.new(
+            "RGB", (layout.page_width, self.head.height + body + 1 + pad), style["background"]
+        )
+        image.paste(self.head, (0, 0))
+        top = self.head.height
+        for tile in tiles:
+            image.paste(tile, (0, top))
+            top += tile.height
+
+        draw = ImageDraw.Draw(image)
+        draw.line([pad, top, pad + layout.table_width - 1, top], fill=style["border"])
+        draw.rectangle([6, 6, image.width - 7, image.height - 7], outline=style["border"])
+        if outfile is not None:
+            image.save(outfile, "PNG")
+        return image
+
+
+def _peak_rss():
+    """Peak RSS in bytes of this process, the rendering happens in it"""
+    import resource
+
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _render_worker(conn):
+    """Resident worker loop, answers (status, value, peak_rss) for every message"""
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        kind, args, limit = msg
+        try:
+            with deadline_scope(Deadline(limit)) if limit is not None else nullcontext():
+                if kind == "ping":
+                    value = os.getpid()
+                elif kind == "pillow":
+                    data, title, outfile = args
+                    value = save_image(render_table_pil(data, title=title), outfile)
+                else:
+                    raise ValueError(f"unknown job kind: {kind}")
+            status = "ok"
+        except Exception as e:
+            status, value = "error", e
+        try:
+            conn.send((status, value, _peak_rss()))
+        except Exception:
+            conn.send(("error", RuntimeError(repr(value)), _peak_rss()))
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.lock = threading.Lock()
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_render_worker, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.jobs = 0
+        self.rss = 0
+
+    def call(self, kind, args, timeout, limit=None):
+        """Run a job, `limit` is the deadline the worker enforces itself"""
+        self.conn.send((kind, args, limit))
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"render worker {self.process.pid} timed out after {timeout}s")
+        status, value, self.rss = self.conn.recv()
+        if status == "error":
+            raise value
+        return value
+
+    def stop(self):
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class RenderPool:
+    """
+    Pre-started processes for the Pillow rasterizer that stay resident between
+    jobs, so Pillow and the fonts are loaded once per worker instead of once
+    per image. wkhtmltoimage renders a single page per process and cannot be
+    kept resident, html pages are always piped to a fresh one.
+
+    Jobs go through a bounded queue, so `submit` blocks once `queue_size` jobs
+    are waiting. A worker is replaced when it dies, times out, has served
+    `max_jobs` jobs or its peak RSS passes `max_rss` bytes.
+
+    Workers are started with the "spawn" method, which re-imports the main
+    module: scripts creating a pool need an `if __name__ == "__main__":` guard.
+    """
+
+    def __init__(self, workers=None, max_jobs=500, max_rss=512 * 1024 * 1024, queue_size=None, timeout=120):
+        import multiprocessing
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self.size = workers or os.cpu_count() or 1
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.recycled = 0
+        self._jobs = queue.Queue(maxsize=queue_size or self.size * 4)
+        self._workers = [_Worker(self._ctx) for _ in range(self.size)]
+        for worker in self._workers:
+            try:
+                worker.call("ping", (), 60)
+            except (EOFError, OSError, TimeoutError) as e:
+                for w in self._workers:
+                    w.stop()
+                raise RuntimeError(
+                    "render worker failed to start; RenderPool spawns its workers by importing "
+                    "the main module, which needs an `if __name__ == '__main__':` guard"
+                ) from e
+        self._threads = [
+            threading.Thread(target=self._dispatch, args=(i,), daemon=True)
+            for i in range(self.size)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _replace(self, i):
+        self._workers[i].stop()
+        self._workers[i] = _Worker(self._ctx)
+        self.recycled += 1
+
+    def _dispatch(self, i):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                return
+            fut, kind, args, deadline = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                limit = deadline.remaining() if deadline is not None else None
+            except RenderError as e:
+                fut.set_exception(e)
+                continue
+
+            worker = self._workers[i]
+            with worker.lock:
+                if not worker.process.is_alive():
+                    self._replace(i)
+                    worker = self._workers[i]
+                # the worker stops at `limit` itself, a cancel terminates it
+                undo = deadline.on_cancel(worker.process.terminate) if deadline is not None else None
+                if deadline is not None:
+                    limit = self.timeout if limit is None else min(limit, self.timeout)
+                timeout = self.timeout if limit is None else limit + 1
+                try:
+                    fut.set_result(worker.call(kind, args, timeout, limit))
+                except (EOFError, OSError, TimeoutError) as e:
+                    self._replace(i)
+                    fut.set_exception(e)
+                    continue
+                except Exception as e:
+                    fut.set_exception(e)
+                finally:
+                    if undo is not None:
+                        undo()
+                worker.jobs += 1
+                if worker.jobs >= self.max_jobs or worker.rss > self.max_rss:
+                    self._replace(i)
+
+    def submit(self, kind, *args, deadline=None):
+        """Queue a job, blocks while the queue is full, returns a Future"""
+        fut = Future()
+        self._jobs.put((fut, kind, args, deadline))
+        return fut
+
+    def _run(self, kind, args, deadline):
+        """
+        Wait for a job within `deadline`: a cancelled job still queued is
+        dropped, a running one is stopped when out of time or cancelled
+        """
+        if deadline is None:
+            return self.submit(kind, *args).result()
+        fut = self.submit(kind, *args, deadline=deadline)
+        undo = deadline.on_cancel(fut.cancel)
+        try:
+            return fut.result()
+        except CancelledError:
+            deadline.remaining()
+            raise
+        finally:
+            undo()
+
+    def render_pil(self, data, outfile, title="", deadline=None):
+        return self._run("pillow", (data, title, outfile), deadline)
+
+    def health(self):
+        """Ping every idle worker, replacing the unresponsive ones"""
+        report = []
+        for i in range(self.size):
+            worker = self._workers[i]
+            if not worker.lock.acquire(timeout=0):
+                report.append({"pid": worker.process.pid, "busy": True, "jobs": worker.jobs, "rss": worker.rss})
+                continue
+            try:
+                try:
+                    worker.call("ping", (), 5)
+                    alive = True
+                except (EOFError, OSError, TimeoutError):
+                    alive = False
+                report.append({"pid": worker.process.pid, "alive": alive, "jobs": worker.jobs, "rss": worker.rss})
+                if not alive:
+                    self._replace(i)
+            finally:
+                worker.lock.release()
+        return report
+
+    def close(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        for worker in self._workers:
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_render_pool = None
+
+
+def enable_render_pool(**kwargs):
+    """Route the Pillow rasterizer of every csv2png through a resident RenderPool"""
+    global _render_pool
+    disable_render_pool()
+    _render_pool = RenderPool(**kwargs)
+    return _render_pool
+
+
+def disable_render_pool():
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.close()
+        _render_pool = None
+
+
+def csv2png(
+    data,
+    outfile=None,
+    prefix=None,
+    suffix=None,
+    title="",
+    engine="local",
+    cache=None,
+    client=None,
+    backend="wkhtmltoimage",
+    theme="table",
+    optimize=None,
+    on_metrics=None,
+    formatter=None,
+    timeout=None,
+    cancel=None,
+    stage_timeouts=None,
+):
+    """
+    outfile: a path or writable binary file, when None the png bytes are returned
+    engine: "local" builds the table html offline,
+            "github" renders the markdown through the GitHub API,
+            or any other registered markdown backend
+    cache: optional MarkdownCache for the "github" engine
+    client: optional HttpClient for the "github" engine
+    backend: rasterizer backend, "wkhtmltoimage" rasterizes the html page,
+             "pillow" draws the table directly (prefix, suffix, engine and theme are unused)
+    formatter: formatter backend turning the rows into html or markdown, see build_html
+    theme: name of a registered stylesheet, see register_theme
+    optimize: True or a dict of optimize_image arguments to recompress the image,
+              the OptimizeResult is returned
+    on_metrics: callback receiving this call's metrics, on top of METRICS_HOOKS
+    timeout: seconds the whole call may take, DeadlineExceeded after that
+    cancel: CancelToken aborting the call with Cancelled
+    stage_timeouts: caps for single stages, {"post_github": 5, "rasterize": 20}
+
+    Failures are raised as RenderError naming the stage. A path `outfile` is
+    written under a temporary name and only renamed into place on success.
+    """
+    kwargs = dict(
+        prefix=prefix,
+        suffix=suffix,
+        title=title,
+        engine=engine,
+        cache=cache,
+        client=client,
+        backend=backend,
+        theme=theme,
+        optimize=optimize,
+        formatter=formatter,
+    )
+    if timeout is None and cancel is None and not stage_timeouts:
+        return _csv2png_measured(data, outfile, on_metrics, kwargs)
+    with deadline_scope(Deadline(timeout, cancel, stage_timeouts)):
+        return _csv2png_measured(data, outfile, on_metrics, kwargs)
+
+
+def _csv2png_measured(data, outfile, on_metrics, kwargs):
+    hooks = METRICS_HOOKS + ([on_metrics] if on_metrics else [])
+    if not hooks or _current_metrics.get() is not None:
+        return _csv2png_atomic(data, outfile, kwargs)
+
+    metrics = Metrics()
+    token = _current_metrics.set(metrics)
+    try:
+        result = _csv2png_atomic(data, outfile, kwargs)
+    except Exception as e:
+        metrics.values.update(ok=False, error=repr(e))
+        if isinstance(e, RenderError):
+            metrics.values["failed_stage"] = e.stage
+        raise
+    else:
+        metrics.values["ok"] = True
+        size = _output_size(result, outfile)
+        if size is not None:
+            metrics.values["image_bytes"] = size
+        return result
+    finally:
+        _current_metrics.reset(token)
+        _emit(metrics, hooks)
+
+
+def _csv2png_atomic(data, outfile, kwargs):
+    return write_atomic(partial(_csv2png, data, **kwargs), outfile)
+
+
+def _output_size(result, outfile):
+    if isinstance(result, OptimizeResult):
+        return result.after
+    if isinstance(result, bytes):
+        return len(result)
+    if isinstance(outfile, str) and os.path.exists(outfile):
+        return os.path.getsize(outfile)
+    return None
+
+
+def render_pil(data, outfile=None, title=""):
+    """Pillow rasterizer, through the render pool when it is enabled"""
+    if _render_pool is None:
+        return save_image(render_table_pil(data, title=title), outfile)
+
+    if not isinstance(data, (str, list)):
+        data = list(iter_rows(data))
+    deadline = _current_deadline.get()
+    if hasattr(outfile, "write"):
+        outfile.write(_render_pool.render_pil(data, None, title, deadline=deadline))
+        return
+    return _render_pool.render_pil(data, outfile, title, deadline=deadline)
+
+
+render_pil.draws_rows = True
+
+register_backend("formatter", "html", table_html)
+register_backend("formatter", "markdown", table_markdown)
+register_backend("markdown", "github", github_markdown)
+register_backend("rasterizer", "wkhtmltoimage", rasterize)
+register_backend("rasterizer", "pillow", render_pil)
+
+
+def _csv2png(
+    data,
+    outfile,
+    prefix,
+    suffix,
+    title,
+    engine,
+    cache,
+    client,
+    backend,
+    theme,
+    optimize,
+    formatter,
+):
+    if optimize:
+        image = csv2png(
+            data,
+            None,
+            prefix=prefix,
+            suffix=suffix,
+            title=title,
+            engine=engine,
+            cache=cache,
+            client=client,
+            backend=backend,
+            theme=theme,
+            formatter=formatter,
+        )
+        with _stage("optimize"):
+            result = optimize_image(image, **(optimize if isinstance(optimize, dict) else {}))
+        write_output(result.data, outfile)
+        return result
+
+    raster = get_backend("rasterizer", backend)
+    if getattr(raster, "draws_rows", False):
+        with _stage("rasterize"):
+            return raster(data, outfile, title)
+
+    html = build_html(
+        data,
+        prefix=prefix,
+        suffix=suffix,
+        title=title,
+        engine=engine,
+        cache=cache,
+        client=client,
+        theme=theme,
+        formatter=formatter,
+    )
+    with _stage("rasterize"):
+        return raster(html, outfile)
+
+
+def csv2png_bytes(data, **kwargs):
+    """csv2png straight to memory, returns the image bytes"""
+    return csv2png(data, None, **kwargs)
+
+
+BatchResult = namedtuple("BatchResult", "index outfile error data", defaults=(None,))
+
+
+# csv2png arguments a csv2png_many job may carry, besides the build_html ones
+_JOB_KEYS = {"outfile", "backend", "optimize", "timeout", "cancel", "stage_timeouts"}
+_BUILD_KEYS = {"data", "prefix", "suffix", "title", "engine", "cache", "client", "theme", "formatter"}
+
+
+def csv2png_many(jobs, threads=8, renderers=None, batch=False, cancel=None):
+    """
+    Render many tables as a pipeline.
+
+    jobs: iterable of dicts with csv2png keyword arguments (`data`, `outfile`,
+          `backend`, `optimize`, ... but not `on_metrics`), `timeout` is
+          counted from when the job starts being built
+    threads: workers building the html (GitHub round trips are I/O bound)
+    renderers: concurrent rasterizer runs, defaults to the cpu count
+    batch: send the markdown of every "github" engine job through
+           post_github_many, a few API calls for the jobs sharing a
+           cache and client, each call bounded by the earliest of their
+           deadlines (the jobs with time left then fetch their own page)
+    cancel: CancelToken aborting every job not finished yet, a job's own
+            `cancel` takes precedence
+
+    Yields a BatchResult per job in completion order, `error` is the exception
+    raised by that job or None, so a bad input never aborts the batch. `data`
+    holds what csv2png would return: the png bytes of a job without `outfile`,
+    or the OptimizeResult of an `optimize` job.
+    """
+    jobs = list(jobs)
+    renderers = renderers or os.cpu_count() or 1
+    results = queue.Queue()
+
+    def build(kwargs, limits, raster):
+        deadline = Deadline(*limits)
+        if getattr(raster, "draws_rows", False):
+            return deadline, kwargs["data"]
+        return deadline, _in_deadline(deadline, build_html, **kwargs)
+
+    def draw(deadline, page, outfile, raster, optimize, title):
+        def write(path):
+            if getattr(raster, "draws_rows", False):
+                return raster(page, path, title)
+            return raster(page, path)
+
+        with deadline_scope(deadline):
+            if not optimize:
+                with _stage("rasterize"):
+                    return write_atomic(write, outfile)
+            with _stage("rasterize"):
+                image = write(None)
+            with _stage("optimize"):
+                result = optimize_image(image, **(optimize if isinstance(optimize, dict) else {}))
+            write_atomic(partial(write_output, result.data), outfile)
+            return result
+
+    def rendered(index, outfile, fut):
+        err = fut.exception()
+        results.put(BatchResult(index, outfile, err, None if err is not None else fut.result()))
+
+    def built(index, outfile, spec, fut):
+        err = fut.exception()
+        if err is not None:
+            results.put(BatchResult(index, outfile, err))
+            return
+        render.submit(draw, *fut.result(), outfile, *spec).add_done_callback(
+            partial(rendered, index, outfile)
+        )
+
+    def finish(page, html):
+        index, outfile, kwargs, deadline, spec, md = page
+        fut = Future()
+        try:
+            with deadline_scope(deadline):
+                if html is None:
+                    with _stage("post_github"):
+                        html = get_backend("markdown", "github")(
+                            md, cache=kwargs.get("cache"), client=kwargs.get("client")
+                        )
+                with _stage("render_page"):
+                    html = render_page(
+                        html, kwargs.get("prefix"), kwargs.get("suffix"), kwargs.get("theme", "table")
+                    )
+            fut.set_result((deadline, html))
+        except Exception as e:
+            fut.set_exception(e)
+        built(index, outfile, spec, fut)
+
+    def fetch_batched(pages):
+        # one call for the jobs sharing a cache and client, bounded by the
+        # earliest of their deadlines and cancelled once all of them are
+        deadlines = [page[3] for page in pages]
+        call = Deadline(cancel=CancelToken())
+        expires = [d.expires for d in deadlines if d.expires is not None]
+        call.expires = min(expires) if expires else None
+        caps = [d.stages["post_github"] for d in deadlines if "post_github" in d.stages]
+        call.stages = {"post_github": min(caps)} if caps else {}
+        left = [len(pages)]
+        lock = threading.Lock()
+
+        def dropped():
+            with lock:
+                left[0] -= 1
+                if left[0]:
+                    return
+            call.cancel.cancel()
+
+        undo = [d.on_cancel(partial(dropped)) for d in deadlines]
+        kwargs = pages[0][2]
+        try:
+            with deadline_scope(call), _stage("post_github"):
+                htmls = post_github_many(
+                    [page[5] for page in pages], cache=kwargs.get("cache"), client=kwargs.get("client")
+                )
+        except (DeadlineExceeded, Cancelled):
+            # the jobs with time left fetch their own page
+            htmls = None
+        except Exception as e:
+            for index, outfile, *_ in pages:
+                results.put(BatchResult(index, outfile, e))
+            return
+        finally:
+            for fn in undo:
+                fn()
+        for i, page in enumerate(pages):
+            if htmls is not None:
+                finish(page, htmls[i])
+            else:
+                fetch.submit(finish, page, None)
+
+    def build_batched(batched):
+        groups = {}
+        for index, outfile, kwargs, limits, spec in batched:
+            deadline = Deadline(*limits)
+            try:
+                with deadline_scope(deadline), _stage("format"):
+                    formatter = get_backend("formatter", kwargs.get("formatter") or "markdown")
+                    md = formatter(kwargs["data"], kwargs.get("title", ""))
+            except Exception as e:
+                results.put(BatchResult(index, outfile, e))
+                continue
+            key = (id(kwargs.get("cache")), id(kwargs.get("client")))
+            groups.setdefault(key, []).append((index, outfile, kwargs, deadline, spec, md))
+        for pages in groups.values():
+            fetch_batched(pages)
+
+    # the render pool is shut down last, builds may still be feeding it
+    with ThreadPoolExecutor(renderers) as render, ThreadPoolExecutor(threads) as fetch:
+        batched = []
+        for index, job in enumerate(jobs):
+            kwargs = dict(job)
+            outfile = kwargs.get("outfile")
+            unknown = set(kwargs) - _JOB_KEYS - _BUILD_KEYS
+            try:
+                if unknown or "data" not in kwargs:
+                    raise TypeError(
+                        f"csv2png_many job {index}: "
+                        + (f"unsupported keys {sorted(unknown)}" if unknown else "no data")
+                    )
+                raster = get_backend("rasterizer", kwargs.pop("backend", None) or "wkhtmltoimage")
+            except Exception as e:
+                results.put(BatchResult(index, outfile, e))
+                continue
+            kwargs.pop("outfile", None)
+            spec = (raster, kwargs.pop("optimize", None), kwargs.get("title", ""))
+            limits = (
+                kwargs.pop("timeout", None),
+                kwargs.pop("cancel", None) or cancel,
+                kwargs.pop("stage_timeouts", None),
+            )
+            if batch and kwargs.get("engine") == "github" and not getattr(raster, "draws_rows", False):
+                batched.append((index, outfile, kwargs, limits, spec))
+                continue
+            fetch.submit(build, kwargs, limits, raster).add_done_callback(
+                partial(built, index, outfile, spec)
+            )
+        if batched:
+            fetch.submit(build_batched, batched)
+
+        for _ in jobs:
+            yield results.get()
+
+
+PageResult = namedtuple("PageResult", "page outfile rows error")
+
+
+def page_rows_for_height(max_height, title="", style=None):
+    """
+    Estimate of how many rows fit in `max_height` pixels: assumes single line
+    cells and the Pillow stylesheet, wkhtmltoimage pages may come out taller
+    """
+    style = dict(PIL_STYLE, **(style or {}))
+    _, pad_y = style["cell_padding"]
+    row = round(style["font_size"] * style["line_height"]) + 2 * pad_y + 1
+    chrome = 2 * style["page_padding"] + row
+    if title:
+        chrome += round(style["font_size"] * style["line_height"]) + style["title_margin"]
+    return max((max_height - chrome) // row, 1)
+
+
+def _pages(data, size):
+    """Chunks of `size` rows, keys ordered by every column seen so far"""
+    columns = {}
+    rows = iter_rows(data)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        for row in chunk:
+            for k in row:
+                columns.setdefault(k, None)
+        yield [{c: row.get(c) for c in columns} for row in chunk]
+
+
+def _pil_pages(data, size, max_height, title=""):
+    """_pages cut where the Pillow drawing of the next row would get taller than `max_height`"""
+    layout = PilLayout([], title)
+    chrome = 2 * layout.style["page_padding"] + layout.title_height + 1
+    columns = {}
+    chunk, height = [], 0
+    for row in iter_rows(data):
+        cells = ["" if v is None else str(v) for v in row.values()]
+        new = [k for k in row if k not in columns]
+        header = layout.row_height([str(c) for c in chain(columns, new)])
+        if chunk and (len(chunk) == size or chrome + header + height + layout.row_height(cells) > max_height):
+            yield [{c: r.get(c) for c in columns} for r in chunk]
+            chunk, height = [], 0
+        columns.update(dict.fromkeys(new))
+        chunk.append(row)
+        height += layout.row_height(cells)
+    if chunk:
+        yield [{c: r.get(c) for c in columns} for r in chunk]
+
+
+def csv2png_pages(data, outfile, page_rows=500, max_height=None, renderers=None, **kwargs):
+    """
+    Split a big table into pages rendered concurrently as outfile-001.png, outfile-002.png, ...
+
+    page_rows: max rows per page
+    max_height: max page height in pixels, further limits the rows per page;
+                exact for the "pillow" backend, which measures every row,
+                an estimate (page_rows_for_height) for html rasterizers
+    kwargs: passed to csv2png (title, engine, backend, ...)
+
+    Every page repeats the header. Rows are read lazily and at most
+    2 * renderers pages are held in memory. Returns a manifest of PageResult
+    in page order, `error` is the exception of a failed page or None.
+    """
+    if max_height and kwargs.get("backend") == "pillow":
+        pages = _pil_pages(data, page_rows, max_height, kwargs.get("title", ""))
+    else:
+        if max_height:
+            page_rows = min(page_rows, page_rows_for_height(max_height, kwargs.get("title", "")))
+        pages = _pages(data, page_rows)
+    renderers = renderers or os.cpu_count() or 1
+    root, ext = os.path.splitext(outfile)
+    slots = threading.BoundedSemaphore(renderers * 2)
+    futures = []
+
+    def render(path, page):
+        try:
+            csv2png(page, path, **kwargs)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(renderers) as pool:
+        for n, page in enumerate(pages, 1):
+            path = f"{root}-{n:03d}{ext or '.png'}"
+            slots.acquire()
+            futures.append((n, path, len(page), pool.submit(render, path, page)))
+
+    return [PageResult(n, path, rows, fut.exception()) for n, path, rows, fut in futures]
+
+
+# bars between the tables of a sheet, a colour tables are unlikely to fill rows with
+SHEET_MARKER = (255, 0, 254)
+
+SheetResult = namedtuple("SheetResult", "index outfile data error")
+
+
+def _sheet_fragments(jobs, engine, cache, client):
+    """html of every job, or the exception that job raised"""
+    texts = {}
+    fragments = [None] * len(jobs)
+    for i, job in enumerate(jobs):
+        try:
+            formatter = get_backend("formatter", job.get("formatter") or ("html" if engine == "local" else "markdown"))
+            with _stage("format"):
+                texts[i] = formatter(job["data"], job.get("title", ""))
+        except Exception as e:
+            fragments[i] = e
+
+    if engine == "local":
+        for i, html in texts.items():
+            fragments[i] = html
+        return fragments
+    try:
+        if engine == "github":
+            with _stage("post_github"):
+                html = post_github_many(list(texts.values()), cache=cache, client=client)
+        else:
+            render_markdown = get_backend("markdown", engine)
+            with _stage("markdown"):
+                html = [render_markdown(text, cache=cache, client=client) for text in texts.values()]
+    except Exception as e:
+        html = [e] * len(texts)
+    for i, fragment in zip(texts, html):
+        fragments[i] = fragment
+    return fragments
+
+
+def sheet_boxes(image, count):
+    """
+    Boxes (left, top, right, bottom) of the `count` tables between the
+    count + 1 marker bars of a rasterized sheet, None when the bars are not
+    all found
+    """
+    from PIL import Image, ImageChops
+
+    rgb = image.convert("RGB")
+    bands = [band.point(lambda v, c=c: 255 if v == c else 0) for band, c in zip(rgb.split(), SHEET_MARKER)]
+    mask = ImageChops.multiply(ImageChops.multiply(bands[0], bands[1]), bands[2])
+    extent = mask.getbbox()
+    if extent is None:
+        return None
+
+    # rows mostly covered by the marker colour, grouped into bars
+    profile = mask.crop((extent[0], 0, extent[2], rgb.height)).resize((1, rgb.height), Image.BOX).getdata()
+    bars = []
+    for y, value in enumerate(profile):
+        if value < 128:
+            continue
+        if bars and bars[-1][1] == y:
+            bars[-1][1] = y + 1
+        else:
+            bars.append([y, y + 1])
+    if len(bars) != count + 1:
+        return None
+    # skip the rows blended into each bar when the page is zoomed
+    return [(extent[0], top + 2, extent[2], bottom - 2) for (_, top), (bottom, _) in zip(bars, bars[1:])]
+
+
+def crop_table(image, box, padding=6):
+    """The table inside `box`, trimmed to its content plus `padding` of background"""
+    from PIL import Image, ImageChops
+
+    region = image.convert("RGB").crop(box)
+    background = region.getpixel((0, 0))
+    content = ImageChops.difference(region, Image.new("RGB", region.size, background)).getbbox()
+    if content is None:
+        content = (0, 0, 1, 1)
+    width, height = content[2] - content[0], content[3] - content[1]
+    out = Image.new("RGB", (width + 2 * padding, height + 2 * padding), background)
+    out.paste(region.crop(content), (padding, padding))
+    return out
+
+
+def csv2png_sheet(
+    jobs,
+    per_sheet=50,
+    prefix=None,
+    suffix=None,
+    engine="local",
+    cache=None,
+    client=None,
+    theme="table",
+    padding=6,
+    timeout=None,
+    cancel=None,
+):
+    """
+    Render many small tables with one wkhtmltoimage run per `per_sheet` of
+    them: the tables are stacked in one page between marker colour bars, the
+    page is rasterized once and cut back into an image per table.
+
+    jobs: iterable of dicts with `data` and optionally `title`, `formatter`, `outfile`
+    engine: as for csv2png, "github" sends the whole sheet in a few calls
+    timeout: seconds each sheet may take, its jobs fail with DeadlineExceeded after that
+    cancel: CancelToken aborting the sheets not finished yet
+
+    Returns a SheetResult per job in order, `data` holds the png when the job
+    has no `outfile`. When the bars of a sheet cannot be found its tables are
+    rasterized one at a time instead. Needs Pillow.
+    """
+    jobs = list(jobs)
+    results = []
+    for start in range(0, len(jobs), per_sheet):
+        group = jobs[start:start + per_sheet]
+        with deadline_scope(Deadline(timeout, cancel)):
+            fragments = _sheet_fragments(group, engine, cache, client)
+            ok = [i for i, fragment in enumerate(fragments) if not isinstance(fragment, Exception)]
+            bar = f'<div style="height:4px;margin:12px 0;background:rgb{SHEET_MARKER}"></div>\n'
+            body = bar + "".join(f"<div>\n{fragments[i]}</div>\n{bar}" for i in ok)
+
+            boxes = error = None
+            if ok:
+                try:
+                    from PIL import Image
+
+                    page = render_page(body, prefix, suffix, theme)
+                    with _stage("rasterize"):
+                        sheet = Image.open(io.BytesIO(rasterize(page)))
+                    boxes = sheet_boxes(sheet, len(ok))
+                except Exception as e:
+                    error = e
+            images = dict(zip(ok, boxes or ()))
+
+            for i, job in enumerate(group):
+                outfile = job.get("outfile")
+                if i not in ok or error is not None:
+                    results.append(SheetResult(start + i, outfile, None, fragments[i] if i not in ok else error))
+                    continue
+                try:
+                    if i in images:
+                        data = write_atomic(partial(save_image, crop_table(sheet, images[i], padding)), outfile)
+                    else:
+                        # the rows are consumed, rasterize the fragment on its own page
+                        page = render_page(fragments[i], prefix, suffix, theme)
+                        with _stage("rasterize"):
+                            data = write_atomic(partial(rasterize, page), outfile)
+                    results.append(SheetResult(start + i, outfile, data, None))
+                except Exception as e:
+                    results.append(SheetResult(start + i, outfile, None, e))
+    return results
+
+
+async def post_github_async(text, mode, context, cache=None, session=None, limiter=None):
+    """post_github on an aiohttp session, which is created per call when not given"""
+    import asyncio
+    import aiohttp
+
+    if cache is not None:
+        key = cache.key(text, mode, context)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    limiter = limiter or default_rate_limiter()
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+    try:
+        while True:
+            await limiter.acquire_async()
+            try:
+                async with session.post(
+                    GITHUB_MARKDOWN_API, data=github_payload(text, mode, context), headers=limiter.headers()
+                ) as res:
+                    r = await res.text(encoding="utf8")
+                    wait = limiter.update(res.status, res.headers)
+            except BaseException:
+                limiter.failed()
+                raise
+            if wait is None:
+                break
+            limiter.check_wait(wait)
+            await asyncio.sleep(wait)
+        if res.status != 200:
+            raise GithubApiError(res.status, r)
+    finally:
+        if own_session:
+            await session.close()
+
+    if cache is not None:
+        cache.set(key, r)
+    return r
+
+
+async def rasterize_async(html, outfile=None, options=None):
+    """
+    rasterize() on the event loop, returns the image bytes without `outfile`.
+    Cancelling the task kills wkhtmltoimage and leaves no partial `outfile`.
+    """
+    import asyncio
+
+    if outfile is not None and hasattr(outfile, "write"):
+        outfile.write(await rasterize_async(html, None, options))
+        return
+    part = outfile and _part_path(outfile)
+    proc = await asyncio.create_subprocess_exec(
+        *wkhtmltoimage_command(part or "-", options),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    try:
+        try:
+            stdout, stderr = await proc.communicate(html.encode("utf8"))
+        except BaseException:
+            if proc.returncode is None:
+                _kill_group(proc)
+                await proc.wait()
+            raise
+        if proc.returncode != 0:
+            raise OSError(
+                f"wkhtmltoimage exited with code {proc.returncode}: {stderr.decode('utf8', 'replace')}"
+            )
+        if outfile is None:
+            return stdout
+        os.replace(part, outfile)
+    finally:
+        if part and os.path.exists(part):
+            os.remove(part)
+
+
+async def csv2png_async(
+    data,
+    outfile=None,
+    prefix=None,
+    suffix=None,
+    title="",
+    engine="local",
+    cache=None,
+    session=None,
+    theme="table",
+    formatter=None,
+    timeout=None,
+    cancel=None,
+):
+    """
+    csv2png that never blocks the event loop.
+
+    session: optional aiohttp.ClientSession for the "github" engine,
+             other markdown backends run in a worker thread
+    timeout, cancel: as for csv2png, the render task is cancelled when either fires
+    """
+    render = _csv2png_async(data, outfile, prefix, suffix, title, engine, cache, session, theme, formatter)
+    if timeout is None and cancel is None:
+        return await render
+    import asyncio
+
+    deadline = Deadline(timeout, cancel)
+    with deadline_scope(deadline):
+        task = asyncio.ensure_future(render)
+    loop = asyncio.get_running_loop()
+    undo = deadline.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        return await asyncio.wait_for(task, timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(deadline.last_stage or "format", "out of time") from None
+    except asyncio.CancelledError:
+        if cancel is None or not cancel.cancelled or not task.cancelled():
+            raise
+        raise Cancelled(deadline.last_stage or "format") from None
+    finally:
+        undo()
+
+
+async def _csv2png_async(data, outfile, prefix, suffix, title, engine, cache, session, theme, formatter):
+    formatter = get_backend("formatter", formatter or ("html" if engine == "local" else "markdown"))
+    with _stage("format"):
+        html = formatter(data, title)
+    if engine == "github":
+        with _stage("post_github"):
+            html = await post_github_async(html, 'markdown', None, cache=cache, session=session)
+    elif engine != "local":
+        import asyncio
+
+        with _stage("markdown"):
+            html = await asyncio.to_thread(get_backend("markdown", engine), html, cache=cache)
+
+    with _stage("render_page"):
+        html = render_page(html, prefix=prefix, suffix=suffix, theme=theme)
+    if os.getenv("DEBUG"):
+        print(html, file=sys.stderr)
+    with _stage("rasterize"):
+        return await rasterize_async(html, outfile)
+
+
+def render_key(data, outfile=None, **options):
+    """
+    sha256 of the rows and every option that changes the image, None when
+    `data` can only be read once (open files, generators). Paths are keyed by
+    their size and mtime, `outfile`, clients, caches and hooks are ignored.
+    """
+    h = hashlib.sha256()
+    if isinstance(data, str):
+        stat = os.stat(data)
+        h.update(f"path:{os.path.abspath(data)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf8"))
+    elif isinstance(data, (list, tuple)):
+        for row in data:
+            h.update(json.dumps(row, ensure_ascii=False, default=str, separators=(",", ":")).encode("utf8"))
+            h.update(b"\n")
+    else:
+        columnar = _columnar(data)
+        if columnar is None:
+            return None
+        names, _, blocks = columnar
+        h.update(json.dumps(names, ensure_ascii=False, default=str).encode("utf8"))
+        for columns in blocks:
+            for column in columns:
+                h.update("\x1f".join(column).encode("utf8"))
+                h.update(b"\x1e")
+
+    options = {k: v for k, v in options.items() if k not in ("cache", "client", "session", "on_metrics")}
+    h.update(json.dumps(options, sort_keys=True, ensure_ascii=False, default=str).encode("utf8"))
+    return h.hexdigest()
+
+
+class SingleFlight:
+    """
+    Run one call per key at a time: callers arriving while it runs wait and
+    get the same result, or the same exception. Threads and asyncio tasks
+    share the calls in flight.
+
+    lock_dir: also coalesce with other processes using the same directory,
+              the first one holds a lock file while rendering and leaves the
+              pickled result for the ones waiting on it (kept `ttl` seconds)
+    """
+
+    def __init__(self, lock_dir=None, ttl=60):
+        self.lock_dir = lock_dir
+        self.ttl = ttl
+        self.runs = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._pruned = 0
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def _join(self, key):
+        """The Future of the call in flight and whether this caller runs it"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.runs += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = self._locked(key, fn, args, kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """do() for a coroutine function, waiting never blocks the event loop"""
+        import asyncio
+
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            if self.lock_dir:
+                lock, cached = await asyncio.to_thread(self._acquire, key)
+                try:
+                    result = cached if cached is not None else await fn(*args, **kwargs)
+                    if cached is None:
+                        await asyncio.to_thread(self._store, key, result)
+                finally:
+                    lock.close()
+            else:
+                result = await fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def _locked(self, key, fn, args, kwargs):
+        if not self.lock_dir:
+            return fn(*args, **kwargs)
+        lock, cached = self._acquire(key)
+        try:
+            if cached is not None:
+                return cached
+            result = fn(*args, **kwargs)
+            self._store(key, result)
+            return result
+        finally:
+            lock.close()
+
+    def _acquire(self, key):
+        """
+        Lock the key across processes, returns (lock file, result) where the
+        result is the one another process finished while we waited, or None
+        """
+        import fcntl
+        import pickle
+
+        started = time.time_ns()
+        path = os.path.join(self.lock_dir, key)
+        lock = open(path + ".lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.stat(path + ".result").st_mtime_ns >= started:
+                with open(path + ".result", "rb") as f:
+                    return lock, pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        return lock, None
+
+    def _store(self, key, result):
+        import pickle
+
+        fd, tmp = tempfile.mkstemp(dir=self.lock_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(result, f)
+        os.replace(tmp, os.path.join(self.lock_dir, key + ".result"))
+        self._prune()
+
+    def _prune(self):
+        """
+        Drop results older than ttl with their idle lock files, at most once
+        per ttl. A process that opened a lock file just before it is removed
+        may render the key a second time, nothing worse.
+        """
+        import fcntl
+
+        now = time.time()
+        if now - self._pruned < self.ttl:
+            return
+        self._pruned = now
+        for path in glob.glob(os.path.join(self.lock_dir, "*.result")):
+            try:
+                if now - os.stat(path).st_mtime <= self.ttl:
+                    continue
+                os.remove(path)
+                with open(path[: -len(".result")] + ".lock", "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(lock.name)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"runs": self.runs, "coalesced": self.coalesced, "inflight": len(self._calls)}
+
+
+_single_flight = None
+
+
+def default_single_flight():
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
+
+
+def _coalesced_output(result, outfile):
+    image = result.data if isinstance(result, OptimizeResult) else result
+    if outfile is None:
+        return result
+    write_output(image, outfile)
+    if isinstance(result, OptimizeResult):
+        return result
+
+
+def csv2png_coalesced(data, outfile=None, flight=None, **kwargs):
+    """
+    csv2png where concurrent calls for the same table and options render
+    once and all get the image; every caller still writes its own `outfile`.
+
+    flight: SingleFlight to coalesce in, a module wide one by default
+    """
+    key = render_key(data, **kwargs)
+    if key is None:
+        return csv2png(data, outfile, **kwargs)
+    result = (flight or default_single_flight()).do(key, csv2png, data, None, **kwargs)
+    return _coalesced_output(result, outfile)
+
+
+async def csv2png_coalesced_async(data, outfile=None, flight=None, **kwargs):
+    """csv2png_async with the coalescing of csv2png_coalesced"""
+    key = render_key(data, **kwargs)
+    if key is None:
+        return await csv2png_async(data, outfile, **kwargs)
+    flight = flight or default_single_flight()
+    result = await flight.do_async(key, csv2png_async, data, None, **kwargs)
+    return _coalesced_output(result, outfile)
+
+
+FONTAWESOME_MINI_WOFF = "d09GRgABAAAAABE0AA8AAAAAHWwAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAABHU1VCAAABWAAAADsAAABUIIslek9TLzIAAAGUAAAAQwAAAFY3d1HZY21hcAAAAdgAAACqAAACOvWLi0FjdnQgAAAChAAAABMAAAAgBtX/BGZwZ20AAAKYAAAFkAAAC3CKkZBZZ2FzcAAACCgAAAAIAAAACAAAABBnbHlmAAAIMAAABdQAAAjkYT9TNWhlYWQAAA4EAAAAMwAAADYQ6WvNaGhlYQAADjgAAAAfAAAAJAc6A1pobXR4AAAOWAAAACAAAAA0Kmz/7mxvY2EAAA54AAAAHAAAABwQPBJubWF4cAAADpQAAAAgAAAAIAEHC/NuYW1lAAAOtAAAAYQAAALxhQT4h3Bvc3QAABA4AAAAfgAAAMS3SYh9cHJlcAAAELgAAAB6AAAAhuVBK7x4nGNgZGBg4GIwYLBjYHJx8wlh4MtJLMljkGJgYYAAkDwymzEnMz2RgQPGA8qxgGkOIGaDiAIAJjsFSAB4nGNgZHZmnMDAysDAVMW0h4GBoQdCMz5gMGRkAooysDIzYAUBaa4pDA4Pwz+yMwf9z2KIYg5imAYUZgTJAQDcoQvQAHic7ZHNDYJAFIRnBXf94cDRIiyCKkCpwFCPJ092RcKNDoYKcN4+EmMPvpdvk539zQyAPYBCXEUJhBcCrJ5SQ9YLnLJe4qF5rdb+uWPDngNHTkta101pNyWa8lMhn6xx2dqUnW4q9YOIhAOOeueMSgsR/6ry+P7O5s6xVNg4chBsHUuFnWNJ8uZYwrw7chrsHXkODo7cB0dHOYCTY8kv0VE2WJKD6gOlWjsxAAB4nGNgQAMSEMgc9D8LhAESbAPdAHicrVZpd9NGFB15SZyELCULLWphxMRpsEYmbMGACUGyYyBdnK2VoIsUO+m+8Ynf4F/zZNpz6Dd+Wu8bLySQtOdwmpOjd+fN1czbZRJaktgL65GUmy/F1NYmjew8CemGTctRfCg7eyFlisnfBVEQrZbatx2HREQiULWusEQQ+x5ZmmR86FFGy7akV03KLT3pLlvjQb1V334aOsqxO6GkZjN0aD2yJVUYVaJIpj1S0qZlqPorSSu8v8LMV81QwohOImm8GcbQSN4bZ7TKaDW24yiKbLLcKFIkmuFBFHmU1RLn5IoJDMoHzZDyyqcR5cP8iKzYo5xWsEu20/y+L3mndzk/sV9vUbbkQB/Ijuzg7HQlX4RbW2HctJPtKFQRdtd3QmzZ7FT/Zo/ymkYDtysyvdCMYKl8hRArP6HM/iFZLZxP+ZJHo1qykRNB62VO7Es+gdbjiClxzRhZ0N3RCRHU/ZIzDPaYPh788d4plgsTAngcy3pHJZwIEylhczRJ2jByYCVliyqp9a6YOOV1WsRbwn7t2tGXzmjjUHdiPFsPHVs5UcnxaFKnmUyd2knNoykNopR0JnjMrwMoP6JJXm1jNYmVR9M4ZsaERCICLdxLU0EsO7GkKQTNoxm9uRumuXYtWqTJA/Xco/f05la4udNT2g70s0Z/VqdiOtgL0+lp5C/xadrlIkXp+ukZfkziQdYCMpEtNsOUgwdv/Q7Sy9eWHIXXBtju7fMrqH3WRPCkAfsb0B5P1SkJTIWYVYhWQGKta1mWydWsFqnI1HdDmla+rNMEinIcF8e+jHH9XzMzlpgSvt+J07MjLj1z7UsI0xx8m3U9mtepxXIBcWZ5TqdZlu/rNMfyA53mWZ7X6QhLW6ejLD/UaYHlRzodY3lBC5p038GQizDkAg6QMISlA0NYXoIhLBUMYbkIQ1gWYQjLJRjC8mMYwnIZhrC8rGXV1FNJ49qZWAZsQmBijh65zEXlaiq5VEK7aFRqQ54SbpVUFM+qf2WgXjzyhjmwFkiXyJpfMc6Vj0bl+NYVLW8aO1fAsepvH472OfFS1ouFPwX/1dZUJb1izcOTq/Abhp5sJ6o2qXh0TZfPVT26/l9UVFgL9BtIhVgoyrJscGcihI86nYZqoJVDzGzMPLTrdcuan8P9NzFCFlD9+DcUGgvcg05ZSVnt4KzV19uy3DuDcjgTLEkxN/P6VvgiI7PSfpFZyp6PfB5wBYxKZdhqA60VvNknMQ+Z3iTPBHFbUTZI2tjOBIkNHPOAefOdBCZh6qoN5E7hhg34BWFuwXknXKJ6oyyH7kXs8yik/Fun4kT2qGiMwLPZG2Gv70LKb3EMJDT5pX4MVBWhqRg1FdA0Um6oBl/G2bptQsYO9CMqdsOyrOLDxxb3lZJtGYR8pIjVo6Of1l6iTqrcfmYUl++dvgXBIDUxf3vfdHGQyrtayTJHbQNTtxqVU9eaQ+NVh+rmUfW94+wTOWuabronHnpf06rbwcVcLLD2bQ7SUiYX1PVhhQ2iy8WlUOplNEnvuAcYFhjQ71CKjf+r+th8nitVhdFxJN9O1LfR52AM/A/Yf0f1A9D3Y+hyDS7P95oTn2704WyZrqIX66foNzBrrblZugbc0HQD4iFHrY64yg18pwZxeqS5HOkh4GPdFeIBwCaAxeAT3bWM5lMAo/mMOT7A58xh0GQOgy3mMNhmzhrADnMY7DKHwR5zGHzBnHWAL5nDIGQOg4g5DJ4wJwB4yhwGXzGHwdfMYfANc+4DfMscBjFzGCTMYbCv6dYwzC1e0F2gtkFVoANTT1jcw+JQU2XI/o4Xhv29Qcz+wSCm/qjp9pD6Ey8M9WeDmPqLQUz9VdOdIfU3Xhjq7wYx9Q+DmPpMvxjLZQa/jHyXCgeUXWw+5++J9w/bxUC5AAEAAf//AA94nIVVX2hbZRQ/5/t7893s5ja9f7ouzdZ0TTqz3bRJmogbWya6bG6Cq0VbSV2ddIJjFtfIQHEig80Hda8yUN/0YQz8AyriiyD+xQd92R4HCnaCb3samnpumrpsCsLlfPf7zvedc37nL3CAtc/5W/wQZGA3tOBSY/g+TMjHmwzEoM1Q8+ZjRZY4oJhmBw5/YB6Za0yC5AkhlwA1A1yCBIBOwCII0Cj0U8BAMdUCzq05sKwkP7SlUY6fcJk4Fb/RyE79/6P5hjM/F4aZiXBoeMgzcqQ4Xi1hPqfDLG5FT+lchCVU3lYMyvuwhl1mqndQL0RsuloLywHtthLXI06OblTrhfWVnpSJ5+mwu/JdbtuN3IAnkW0LLMcRwaC7ktrlzridM6kVdyf9uO1UNBByI7JhwtG2sEwab07ORBeilWhqavJCqV0qzZTOl/7ZXQ5TbTcdcFelyGhhRDAQpdqp1FEX3w3cFTc1k9pJQkmm4ySCbSikxRP2QOfN+0tHS5MrpQuTU1Mk5nw0E5Xa0WvrOwDyGax9yB9ma6DAg82wHc43SAGTI4GjBWebOePAERFE8/AHaQpZASSTy8A4WwZiLQMQ82mFKATO0ILicRAoDm9p5P99E5b/fXG+kQYY3TYUuqmERWYoT0u/GNYL2q/4WB3LaVS+VynXsVYIcWw6DkCh3nX1D+VzlYN4LClF5yexSQos8exqZ3KVP+wtrC54u4Nznq6cq+xpMpUUnZ8FUYzE86ud0g28NOIv3Gj5/rmA3ABs7S/ywzFuQ4qyd6QxfNtiQIaEgp3w/entQg4Vcbqa16M5FfpeUB8t1+qeg7mI7cUyOe79wOk86gSxkVec4KPTX69++5x68Yubn5/F+w52z7u08sJX7fZXv8ekT/d2mILJxq6sn+SC6qEJknzLJCxyZEKwWVqYmAPBxBE/9DLeZiWHu7lcr/VytrCRuHojncNuTt9h46tmacmYisnSamdN2bZptcsmSysdVsy1PrOvOzF3xN64Rb937t/og9KHxYdcjIUqFAmIAHGHNzlns+RTPgeUYAQm9DwpNxfxbhhBHPaw3/gfTcXO2L+eJVIx5nsyGkvm9X4/f+bGkH45G0PaSjcMXTjcZyTvi3UdHoCDjQd3IDUVsgwYmUoJK/gp4JJxeRI0MKHZIkgynyIBqBTOUs6rOVCojvjZ4mCQz49ZMlMcp8QoYk6NoBfsxnJtsBohpa8iGJS+ZH7gU7NxME6cmF+t7cO9vB8d3jTWSct0ycW9ranXmolNDwmVkNnxe+8JtoztwS5rKJ0xWS95tQ/1zMYzg69MzUZnNtl1ofNbsml/OJm6f9wjRjpnu2o4MzHzn77IQkRd+1DjwMQ2pqSjGMMhyjrgTbBAKksuUm0iU7hI0aN2wOKOq7WYBSH0HGihj/jkiPxAfmwsEbfYrjMG+j3ij932Db/LV7I/xruNrhnroxjR9HRMb2nTvO0ZXOoHPk8H2ZhDPx93qcE/53sH5np/dkIP7zzhTVKdR/BAY/9ElkkR+A6lJGsqpJ4oQcTxpvBT3Kn58VkaJjgHyPEIws57xkaHh9KuVpDEpJZeMbZ5w/zBHi5NMQ4r5VphsFqID7TyB9eR4pX216c3AHxpdAwoqU9qg0ZJ6yVLKmMSz1iG2z27ifx18NkY0LPx1W/wCc2l5LrznrIsiKsqbmB78A9wIGx4tI8rjihVHJyY9pgMirenVq0yWg7Iw7eogG7ZgYM3qR9959A/fZkg6MnD/exlkmc+jWV4SB15XUR+eqC6l6ZmgPtN9z5JMfik05OV8ljylunJ4J+wA/FUaQSSKotsYsCWqaPBidBLcxkWx7XKFRIb45TGaEhjlF9uUVPqXOtcIwsXbBvfoZXIyRYFdkfnqjExH98xpnPczqzjX/uNdO1Y17Wpi5+6Ts8BXtjVFasp9KZ1mOiNbH65c5w6HgmyF2jFCZywM8mWjRc7T5Pmt0lRy7Y71+jYbpGyvwG4sH0XeJxjYGRgYADiwBB/53h+m68M3MwvgCIM1z5N/g6j///9v5H5BbMnkMvBwAQSBQCIcA9gAHicY2BkYGAO+p8FJF/8//v/F/MLBqAICuAFALYQB5kAeJxjfsHAwLwAiCNB+P9fbJjJmoGBMRUo/wKCAfO2EnQAAAAAANoBXgGcAgICVALaA1IDvAPkBAYEPARyAAEAAAANAF0ABAAAAAAAAgAUACQAcwAAAG4LcAAAAAB4nHWRzWrCQBSFT+pPqUIXLXTTzayKUohGKIibCoLuhbrrYtTRxCYZmYyKyz5Fd32HvlDfoO/QkziIFJtw9bvnnpl7ZwLgBt/wcHieGAf2UGd24Atcou+4RH3kuEweO66QXx1XyaHjGh6ROa7jFp/cwStfMVvhy7GHO+/e8QWuvcBxifqz4zL5xXGF/Oa4Sn53XMPE+3Bcx4P3M9DrvYmWoRWNQVN02kFXTPdCU4pSGQu5saE2meiLhU6timPtz3SSs9ypTCdqrJabWJoT5QQnymSRTkXgt0/UkUqVkVbN807ZdtmxdiEWRidi6HqItdErNbN+aO2612qd9sYAGmvsYRBhyUu0EGhQbfK/gzYCdElTOgSdB1eEFBIxFYkNV4RFJWPeZyyYpVQVHTHZx4y/yVGX2LGWFZri51TccUOn5B7nPefVCSPvGhVVwUl9znveO2KkhV8Wk82PZ8qwZf8OVcu1+fSmWCMw/HMOwXvKaysqM+p+cVuWag8tvv+c+xdd+4+teJxtjUEOwiAURJla24KliQfhUA2g/Sl+CKXx+loNrpzVezOLEY34Ron/0WhwQoszOvQYIKFwwQiNSbSBeO2SZ0tBP4j3zVjKNng32ZmtD1VVXCuOiw/pJ8S3WOU6l+K5UOTaDC4+2TjKMtN9KQf1ezLx/Sg/00FCvABHhjDjAAB4nGPw3sFwIihiIyNjX+QGxp0cDBwMyQUbGVidNjEwMmiBGJu5mBg5ICw+BjCLzWkX0wGgNCeQze60i8EBwmZmcNmowtgRGLHBoSNiI3OKy0Y1EG8XRwMDI4tDR3JIBEhJJBBs5mFi5NHawfi/dQNL70YmBhcADHYj9AAA"
+
+# the full markdown stylesheet the pages used to inline
+GITHUB_CSS = """
     body {
       max-width: 1366px;
       border: 1px solid #ddd;
@@ -88,7 +2853,7 @@ def render_page(body, prefix=None, suffix=None):
 
     @font-face {
       font-family: fontawesome-mini;
-      src: url(data:font/woff;charset=utf-8;base64,d09GRgABAAAAABE0AA8AAAAAHWwAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAABHU1VCAAABWAAAADsAAABUIIslek9TLzIAAAGUAAAAQwAAAFY3d1HZY21hcAAAAdgAAACqAAACOvWLi0FjdnQgAAAChAAAABMAAAAgBtX/BGZwZ20AAAKYAAAFkAAAC3CKkZBZZ2FzcAAACCgAAAAIAAAACAAAABBnbHlmAAAIMAAABdQAAAjkYT9TNWhlYWQAAA4EAAAAMwAAADYQ6WvNaGhlYQAADjgAAAAfAAAAJAc6A1pobXR4AAAOWAAAACAAAAA0Kmz/7mxvY2EAAA54AAAAHAAAABwQPBJubWF4cAAADpQAAAAgAAAAIAEHC/NuYW1lAAAOtAAAAYQAAALxhQT4h3Bvc3QAABA4AAAAfgAAAMS3SYh9cHJlcAAAELgAAAB6AAAAhuVBK7x4nGNgZGBg4GIwYLBjYHJx8wlh4MtJLMljkGJgYYAAkDwymzEnMz2RgQPGA8qxgGkOIGaDiAIAJjsFSAB4nGNgZHZmnMDAysDAVMW0h4GBoQdCMz5gMGRkAooysDIzYAUBaa4pDA4Pwz+yMwf9z2KIYg5imAYUZgTJAQDcoQvQAHic7ZHNDYJAFIRnBXf94cDRIiyCKkCpwFCPJ092RcKNDoYKcN4+EmMPvpdvk539zQyAPYBCXEUJhBcCrJ5SQ9YLnLJe4qF5rdb+uWPDngNHTkta101pNyWa8lMhn6xx2dqUnW4q9YOIhAOOeueMSgsR/6ry+P7O5s6xVNg4chBsHUuFnWNJ8uZYwrw7chrsHXkODo7cB0dHOYCTY8kv0VE2WJKD6gOlWjsxAAB4nGNgQAMSEMgc9D8LhAESbAPdAHicrVZpd9NGFB15SZyELCULLWphxMRpsEYmbMGACUGyYyBdnK2VoIsUO+m+8Ynf4F/zZNpz6Dd+Wu8bLySQtOdwmpOjd+fN1czbZRJaktgL65GUmy/F1NYmjew8CemGTctRfCg7eyFlisnfBVEQrZbatx2HREQiULWusEQQ+x5ZmmR86FFGy7akV03KLT3pLlvjQb1V334aOsqxO6GkZjN0aD2yJVUYVaJIpj1S0qZlqPorSSu8v8LMV81QwohOImm8GcbQSN4bZ7TKaDW24yiKbLLcKFIkmuFBFHmU1RLn5IoJDMoHzZDyyqcR5cP8iKzYo5xWsEu20/y+L3mndzk/sV9vUbbkQB/Ijuzg7HQlX4RbW2HctJPtKFQRdtd3QmzZ7FT/Zo/ymkYDtysyvdCMYKl8hRArP6HM/iFZLZxP+ZJHo1qykRNB62VO7Es+gdbjiClxzRhZ0N3RCRHU/ZIzDPaYPh788d4plgsTAngcy3pHJZwIEylhczRJ2jByYCVliyqp9a6YOOV1WsRbwn7t2tGXzmjjUHdiPFsPHVs5UcnxaFKnmUyd2knNoykNopR0JnjMrwMoP6JJXm1jNYmVR9M4ZsaERCICLdxLU0EsO7GkKQTNoxm9uRumuXYtWqTJA/Xco/f05la4udNT2g70s0Z/VqdiOtgL0+lp5C/xadrlIkXp+ukZfkziQdYCMpEtNsOUgwdv/Q7Sy9eWHIXXBtju7fMrqH3WRPCkAfsb0B5P1SkJTIWYVYhWQGKta1mWydWsFqnI1HdDmla+rNMEinIcF8e+jHH9XzMzlpgSvt+J07MjLj1z7UsI0xx8m3U9mtepxXIBcWZ5TqdZlu/rNMfyA53mWZ7X6QhLW6ejLD/UaYHlRzodY3lBC5p038GQizDkAg6QMISlA0NYXoIhLBUMYbkIQ1gWYQjLJRjC8mMYwnIZhrC8rGXV1FNJ49qZWAZsQmBijh65zEXlaiq5VEK7aFRqQ54SbpVUFM+qf2WgXjzyhjmwFkiXyJpfMc6Vj0bl+NYVLW8aO1fAsepvH472OfFS1ouFPwX/1dZUJb1izcOTq/Abhp5sJ6o2qXh0TZfPVT26/l9UVFgL9BtIhVgoyrJscGcihI86nYZqoJVDzGzMPLTrdcuan8P9NzFCFlD9+DcUGgvcg05ZSVnt4KzV19uy3DuDcjgTLEkxN/P6VvgiI7PSfpFZyp6PfB5wBYxKZdhqA60VvNknMQ+Z3iTPBHFbUTZI2tjOBIkNHPOAefOdBCZh6qoN5E7hhg34BWFuwXknXKJ6oyyH7kXs8yik/Fun4kT2qGiMwLPZG2Gv70LKb3EMJDT5pX4MVBWhqRg1FdA0Um6oBl/G2bptQsYO9CMqdsOyrOLDxxb3lZJtGYR8pIjVo6Of1l6iTqrcfmYUl++dvgXBIDUxf3vfdHGQyrtayTJHbQNTtxqVU9eaQ+NVh+rmUfW94+wTOWuabronHnpf06rbwcVcLLD2bQ7SUiYX1PVhhQ2iy8WlUOplNEnvuAcYFhjQ71CKjf+r+th8nitVhdFxJN9O1LfR52AM/A/Yf0f1A9D3Y+hyDS7P95oTn2704WyZrqIX66foNzBrrblZugbc0HQD4iFHrY64yg18pwZxeqS5HOkh4GPdFeIBwCaAxeAT3bWM5lMAo/mMOT7A58xh0GQOgy3mMNhmzhrADnMY7DKHwR5zGHzBnHWAL5nDIGQOg4g5DJ4wJwB4yhwGXzGHwdfMYfANc+4DfMscBjFzGCTMYbCv6dYwzC1e0F2gtkFVoANTT1jcw+JQU2XI/o4Xhv29Qcz+wSCm/qjp9pD6Ey8M9WeDmPqLQUz9VdOdIfU3Xhjq7wYx9Q+DmPpMvxjLZQa/jHyXCgeUXWw+5++J9w/bxUC5AAEAAf//AA94nIVVX2hbZRQ/5/t7893s5ja9f7ouzdZ0TTqz3bRJmogbWya6bG6Cq0VbSV2ddIJjFtfIQHEig80Hda8yUN/0YQz8AyriiyD+xQd92R4HCnaCb3samnpumrpsCsLlfPf7zvedc37nL3CAtc/5W/wQZGA3tOBSY/g+TMjHmwzEoM1Q8+ZjRZY4oJhmBw5/YB6Za0yC5AkhlwA1A1yCBIBOwCII0Cj0U8BAMdUCzq05sKwkP7SlUY6fcJk4Fb/RyE79/6P5hjM/F4aZiXBoeMgzcqQ4Xi1hPqfDLG5FT+lchCVU3lYMyvuwhl1mqndQL0RsuloLywHtthLXI06OblTrhfWVnpSJ5+mwu/JdbtuN3IAnkW0LLMcRwaC7ktrlzridM6kVdyf9uO1UNBByI7JhwtG2sEwab07ORBeilWhqavJCqV0qzZTOl/7ZXQ5TbTcdcFelyGhhRDAQpdqp1FEX3w3cFTc1k9pJQkmm4ySCbSikxRP2QOfN+0tHS5MrpQuTU1Mk5nw0E5Xa0WvrOwDyGax9yB9ma6DAg82wHc43SAGTI4GjBWebOePAERFE8/AHaQpZASSTy8A4WwZiLQMQ82mFKATO0ILicRAoDm9p5P99E5b/fXG+kQYY3TYUuqmERWYoT0u/GNYL2q/4WB3LaVS+VynXsVYIcWw6DkCh3nX1D+VzlYN4LClF5yexSQos8exqZ3KVP+wtrC54u4Nznq6cq+xpMpUUnZ8FUYzE86ud0g28NOIv3Gj5/rmA3ABs7S/ywzFuQ4qyd6QxfNtiQIaEgp3w/entQg4Vcbqa16M5FfpeUB8t1+qeg7mI7cUyOe79wOk86gSxkVec4KPTX69++5x68Yubn5/F+w52z7u08sJX7fZXv8ekT/d2mILJxq6sn+SC6qEJknzLJCxyZEKwWVqYmAPBxBE/9DLeZiWHu7lcr/VytrCRuHojncNuTt9h46tmacmYisnSamdN2bZptcsmSysdVsy1PrOvOzF3xN64Rb937t/og9KHxYdcjIUqFAmIAHGHNzlns+RTPgeUYAQm9DwpNxfxbhhBHPaw3/gfTcXO2L+eJVIx5nsyGkvm9X4/f+bGkH45G0PaSjcMXTjcZyTvi3UdHoCDjQd3IDUVsgwYmUoJK/gp4JJxeRI0MKHZIkgynyIBqBTOUs6rOVCojvjZ4mCQz49ZMlMcp8QoYk6NoBfsxnJtsBohpa8iGJS+ZH7gU7NxME6cmF+t7cO9vB8d3jTWSct0ycW9ranXmolNDwmVkNnxe+8JtoztwS5rKJ0xWS95tQ/1zMYzg69MzUZnNtl1ofNbsml/OJm6f9wjRjpnu2o4MzHzn77IQkRd+1DjwMQ2pqSjGMMhyjrgTbBAKksuUm0iU7hI0aN2wOKOq7WYBSH0HGihj/jkiPxAfmwsEbfYrjMG+j3ij932Db/LV7I/xruNrhnroxjR9HRMb2nTvO0ZXOoHPk8H2ZhDPx93qcE/53sH5np/dkIP7zzhTVKdR/BAY/9ElkkR+A6lJGsqpJ4oQcTxpvBT3Kn58VkaJjgHyPEIws57xkaHh9KuVpDEpJZeMbZ5w/zBHi5NMQ4r5VphsFqID7TyB9eR4pX216c3AHxpdAwoqU9qg0ZJ6yVLKmMSz1iG2z27ifx18NkY0LPx1W/wCc2l5LrznrIsiKsqbmB78A9wIGx4tI8rjihVHJyY9pgMirenVq0yWg7Iw7eogG7ZgYM3qR9959A/fZkg6MnD/exlkmc+jWV4SB15XUR+eqC6l6ZmgPtN9z5JMfik05OV8ljylunJ4J+wA/FUaQSSKotsYsCWqaPBidBLcxkWx7XKFRIb45TGaEhjlF9uUVPqXOtcIwsXbBvfoZXIyRYFdkfnqjExH98xpnPczqzjX/uNdO1Y17Wpi5+6Ts8BXtjVFasp9KZ1mOiNbH65c5w6HgmyF2jFCZywM8mWjRc7T5Pmt0lRy7Y71+jYbpGyvwG4sH0XeJxjYGRgYADiwBB/53h+m68M3MwvgCIM1z5N/g6j///9v5H5BbMnkMvBwAQSBQCIcA9gAHicY2BkYGAO+p8FJF/8//v/F/MLBqAICuAFALYQB5kAeJxjfsHAwLwAiCNB+P9fbJjJmoGBMRUo/wKCAfO2EnQAAAAAANoBXgGcAgICVALaA1IDvAPkBAYEPARyAAEAAAANAF0ABAAAAAAAAgAUACQAcwAAAG4LcAAAAAB4nHWRzWrCQBSFT+pPqUIXLXTTzayKUohGKIibCoLuhbrrYtTRxCYZmYyKyz5Fd32HvlDfoO/QkziIFJtw9bvnnpl7ZwLgBt/wcHieGAf2UGd24Atcou+4RH3kuEweO66QXx1XyaHjGh6ROa7jFp/cwStfMVvhy7GHO+/e8QWuvcBxifqz4zL5xXGF/Oa4Sn53XMPE+3Bcx4P3M9DrvYmWoRWNQVN02kFXTPdCU4pSGQu5saE2meiLhU6timPtz3SSs9ypTCdqrJabWJoT5QQnymSRTkXgt0/UkUqVkVbN807ZdtmxdiEWRidi6HqItdErNbN+aO2612qd9sYAGmvsYRBhyUu0EGhQbfK/gzYCdElTOgSdB1eEFBIxFYkNV4RFJWPeZyyYpVQVHTHZx4y/yVGX2LGWFZri51TccUOn5B7nPefVCSPvGhVVwUl9znveO2KkhV8Wk82PZ8qwZf8OVcu1+fSmWCMw/HMOwXvKaysqM+p+cVuWag8tvv+c+xdd+4+teJxtjUEOwiAURJla24KliQfhUA2g/Sl+CKXx+loNrpzVezOLEY34Ron/0WhwQoszOvQYIKFwwQiNSbSBeO2SZ0tBP4j3zVjKNng32ZmtD1VVXCuOiw/pJ8S3WOU6l+K5UOTaDC4+2TjKMtN9KQf1ezLx/Sg/00FCvABHhjDjAAB4nGPw3sFwIihiIyNjX+QGxp0cDBwMyQUbGVidNjEwMmiBGJu5mBg5ICw+BjCLzWkX0wGgNCeQze60i8EBwmZmcNmowtgRGLHBoSNiI3OKy0Y1EG8XRwMDI4tDR3JIBEhJJBBs5mFi5NHawfi/dQNL70YmBhcADHYj9AAA) format('woff');
+      src: url(fontawesome-mini.woff) format('woff');
     }
 
     .markdown-body {
@@ -1072,10 +3837,519 @@ def render_page(body, prefix=None, suffix=None):
         page-break-after: avoid;
       }
     }
-    </style>
+"""
+
+# only what a title and a table need
+TABLE_CSS = """
+    body {
+      max-width: 1366px;
+      border: 1px solid #ddd;
+      margin: 6px;
+      zoom: 0.9;
+    }
+
+    body .markdown-body
+    {
+      padding: 15px;
+    }
+
+    .markdown-body {
+      color: #333333;
+      font-family: "Helvetica Neue", Helvetica, "Segoe UI", Arial, freesans,
+        "Microsoft Yahei", "Nimbus Sans L", "Liberation Sans", "PingFang SC",
+        "Hiragino Sans GB", "Source Han Sans CN", "WenQuanYi Zen Hei", SimHei,
+        noto, sans-serif;
+      font-size: 16px;
+      line-height: 1.6;
+      word-wrap: break-word;
+    }
+
+    .markdown-body p,
+    .markdown-body table {
+      margin-top: 0;
+      margin-bottom: 16px;
+    }
+
+    .markdown-body>*:first-child {
+      margin-top: 0 !important;
+    }
+
+    .markdown-body>*:last-child {
+      margin-bottom: 0 !important;
+    }
+
+    .markdown-body table {
+      display: block;
+      width: 100%;
+      overflow: auto;
+      word-break: keep-all;
+      border-collapse: collapse;
+      border-spacing: 0;
+    }
+
+    .markdown-body table th {
+      font-weight: bold;
+    }
+
+    .markdown-body table th,
+    .markdown-body table td {
+      padding: 6px 13px;
+      border: 1px solid #ddd;
+    }
+
+    .markdown-body table tr {
+      background-color: #fff;
+      border-top: 1px solid #ccc;
+    }
+
+    .markdown-body table tr:nth-child(2n) {
+      background-color: #f8f8f8;
+    }
+"""
+
+THEMES = {}
+_theme_paths = {}
+_theme_lock = threading.Lock()
+
+
+def register_theme(name, css, assets=None):
+    """
+    Register a stylesheet under `name`.
+
+    assets: {filename: bytes} written next to the stylesheet,
+            so the css can refer to them by relative url
+    """
+    THEMES[name] = (css, assets or {})
+    _theme_paths.pop(name, None)
+
+
+register_theme("table", TABLE_CSS)
+register_theme(
+    "github",
+    GITHUB_CSS,
+    {"fontawesome-mini.woff": lambda: base64.b64decode(FONTAWESOME_MINI_WOFF)},
+)
+
+
+def theme_stylesheet(name):
+    """
+    Path of the theme stylesheet in THEME_CACHE, written on first use.
+    The directory name carries a hash of the css so edited themes never go stale.
+    """
+    if name in _theme_paths:
+        return _theme_paths[name]
+
+    css, assets = THEMES[name]
+    digest = hashlib.sha256(css.encode("utf8")).hexdigest()[:12]
+    directory = os.path.join(THEME_CACHE, "themes", f"{name}-{digest}")
+    path = os.path.join(directory, "style.css")
+    with _theme_lock:
+        if os.path.exists(path):
+            _theme_paths[name] = path
+            return path
+        os.makedirs(directory, exist_ok=True)
+        for filename, content in assets.items():
+            content = content() if callable(content) else content
+            with open(os.path.join(directory, filename), "wb") as f:
+                f.write(content)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf8") as f:
+            f.write(css)
+        os.replace(tmp, path)
+        _theme_paths[name] = path
+    return path
+
+
+def render_page(body, prefix=None, suffix=None, theme="table"):
+    prefix = prefix or f"""
+    <html>
+    <head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <link rel="stylesheet" href="file://{theme_stylesheet(theme)}">
     </head>
     <body>
     <div class="markdown-body">
     """
     suffix = suffix or "</div></body></html>"
     return prefix + body + suffix
+
+
+INPUT_EXTENSIONS = (".json", ".csv", ".ndjson", ".jsonl")
+
+
+def find_inputs(patterns):
+    """Expand files, directories (their data files) and glob patterns"""
+    found = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found.extend(
+                sorted(
+                    os.path.join(pattern, name)
+                    for name in os.listdir(pattern)
+                    if name.lower().endswith(INPUT_EXTENSIONS)
+                )
+            )
+        elif glob.has_magic(pattern):
+            found.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            found.append(pattern)
+    return list(dict.fromkeys(found))
+
+
+def output_path(infile, out, ext, single):
+    if single and out and not os.path.isdir(out) and os.path.splitext(out)[1]:
+        return out
+    stem = os.path.splitext(os.path.basename(infile))[0]
+    return os.path.join(out or os.path.dirname(infile), stem + ext)
+
+
+def is_fresh(infile, outfile):
+    try:
+        return os.path.getmtime(outfile) >= os.path.getmtime(infile)
+    except OSError:
+        return False
+
+
+def _render_file(infile, outfile, kwargs):
+    start = time.perf_counter()
+    csv2png(infile, outfile, **kwargs)
+    return time.perf_counter() - start
+
+
+def cmd_render(args):
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        print("no input files", file=sys.stderr)
+        return 1
+    ext = "." + ("jpg" if args.format == "jpeg" else args.format)
+    kwargs = {
+        "title": args.title,
+        "engine": args.engine,
+        "backend": args.backend,
+        "theme": args.theme,
+        "formatter": args.formatter,
+        "timeout": args.timeout,
+    }
+    if args.format != "png" or args.optimize:
+        kwargs["optimize"] = {"format": args.format}
+
+    pairs = [(infile, output_path(infile, args.output, ext, len(inputs) == 1)) for infile in inputs]
+    outputs = {}
+    for infile, outfile in pairs:
+        other = outputs.setdefault(os.path.abspath(outfile), infile)
+        if other != infile:
+            print(f"{other} and {infile} would both render to {outfile}", file=sys.stderr)
+            return 1
+
+    jobs = []
+    for infile, outfile in pairs:
+        if not args.force and is_fresh(infile, outfile):
+            if not args.quiet:
+                print(f"skip {infile}: {outfile} is up to date", file=sys.stderr)
+            continue
+        # -o may name a directory that does not exist yet, for one input too
+        if os.path.dirname(outfile):
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+        jobs.append((infile, outfile))
+
+    failed = 0
+    with ThreadPoolExecutor(args.jobs) as pool:
+        futures = {
+            pool.submit(_render_file, infile, outfile, kwargs): (infile, outfile)
+            for infile, outfile in jobs
+        }
+        for n, fut in enumerate(as_completed(futures), 1):
+            infile, outfile = futures[fut]
+            err = fut.exception()
+            if err is not None:
+                failed += 1
+                print(f"[{n}/{len(jobs)}] FAIL {infile}: {err}", file=sys.stderr)
+            elif not args.quiet:
+                print(f"[{n}/{len(jobs)}] {infile} -> {outfile} {fut.result():.2f}s", file=sys.stderr)
+    return 1 if failed else 0
+
+
+IMAGE_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """
+    POST /render  {"rows": [...], "title": "", "theme": "table", "format": "png", ...}
+    GET  /health
+    GET  /metrics  (Prometheus text format)
+    """
+
+    server_version = f"d2png/{version}"
+    # seconds a client may stall sending its request, slow or short bodies would pin the thread
+    timeout = 30
+
+    def _send(self, status, body=b"", content_type="text/plain; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.server.metrics.render().encode("utf8")
+            return self._send(200, body, "text/plain; version=0.0.4")
+        if self.path != "/health":
+            return self._send(404, b"not found")
+        body = json.dumps(self.server.health()).encode("utf8")
+        self._send(200, body, "application/json")
+
+    def do_POST(self):
+        if self.path != "/render":
+            return self._send(404, b"not found")
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            return self._send(400, b"bad request: invalid Content-Length")
+        if length > self.server.max_body:
+            self.close_connection = True
+            return self._send(413, f"request body above {self.server.max_body} bytes".encode("utf8"))
+        try:
+            body = self.rfile.read(length)
+            if len(body) < length:
+                raise ValueError("body shorter than Content-Length")
+            req = json.loads(body)
+            rows, fmt = self._validate(req)
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(400, f"bad request: {e}".encode("utf8"))
+
+        canonical = json.dumps(req, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        digest = hashlib.sha256(canonical.encode("utf8")).hexdigest()
+        etag = f'"{digest}"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, headers=headers)
+
+        try:
+            image = self.server.flight.do(digest, self._render, req, rows, fmt)
+        except DeadlineExceeded as e:
+            return self._send(504, f"render timed out: {e}".encode("utf8"))
+        except Exception as e:
+            return self._send(500, f"render failed: {e}".encode("utf8"))
+        if image is None:
+            return self._send(503, b"render queue is full", headers={"Retry-After": "1"})
+
+        if fmt != "png":
+            image = image.data
+        self._send(200, image, IMAGE_TYPES[fmt], headers)
+
+    def _validate(self, req):
+        """
+        Rows must be inline, a string would be read as a path on the server,
+        and engines and backends are limited to the ones the server allows
+        """
+        if not isinstance(req, dict):
+            raise ValueError("expected a JSON object")
+        rows = req["rows"]
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("rows must be a list of objects")
+        if len(rows) > self.server.max_rows:
+            raise ValueError(f"more than {self.server.max_rows} rows")
+        fmt = req.get("format", "png")
+        if fmt not in IMAGE_TYPES:
+            raise ValueError(f"unknown format: {fmt}")
+        if not isinstance(req.get("title", ""), str):
+            raise ValueError("title must be a string")
+        if req.get("theme", "table") not in THEMES:
+            raise ValueError(f"unknown theme: {req['theme']}")
+        if req.get("engine", "local") not in self.server.engines:
+            raise ValueError(f"engine not allowed: {req['engine']}")
+        if req.get("backend", self.server.backend) not in self.server.backends:
+            raise ValueError(f"backend not allowed: {req['backend']}")
+        return rows, fmt
+
+    def _render(self, req, rows, fmt):
+        """Render once for every identical request in flight, None when the queue is full"""
+        if not self.server.acquire():
+            return None
+        try:
+            return csv2png(
+                rows,
+                None,
+                title=req.get("title", ""),
+                theme=req.get("theme", "table"),
+                engine=req.get("engine", "local"),
+                backend=req.get("backend", self.server.backend),
+                client=self.server.client,
+                cache=self.server.cache,
+                optimize={"format": fmt} if fmt != "png" else None,
+                timeout=self.server.render_timeout,
+            )
+        finally:
+            self.server.release()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class RenderServer(ThreadingHTTPServer):
+    """
+    HTTP rendering service sharing one HttpClient, markdown cache and
+    optionally a resident RenderPool for the Pillow backend between requests.
+
+    At most `concurrency` renders run at once and `queue_size` more may wait,
+    further requests get 503. Identical requests in flight share one render,
+    across server processes too when they share `lock_dir`. A render taking
+    longer than `timeout` seconds is aborted and answered with 504.
+
+    Requests may only pick the markdown `engines` listed ("github" spends the
+    server's token quota) and the rasterizer `backend`, and are limited to
+    `max_body` bytes and `max_rows` rows.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        concurrency=None,
+        queue_size=64,
+        backend="wkhtmltoimage",
+        pool=False,
+        quiet=False,
+        lock_dir=None,
+        timeout=None,
+        engines=("local",),
+        max_body=16 * 1024 * 1024,
+        max_rows=100000,
+    ):
+        super().__init__(address, RenderHandler)
+        self.concurrency = concurrency or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.backend = backend
+        self.quiet = quiet
+        self.engines = set(engines)
+        self.backends = {backend}
+        self.max_body = max_body
+        self.max_rows = max_rows
+        # BaseServer.timeout is the handle_request() poll timeout
+        self.render_timeout = timeout
+        self.client = HttpClient(pool_size=self.concurrency)
+        self.cache = MarkdownCache()
+        self.pool = enable_render_pool(workers=self.concurrency) if pool else None
+        self.metrics = add_metrics_hook(PrometheusExporter())
+        self.flight = SingleFlight(lock_dir)
+        self.inflight = 0
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+        self._slots.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.inflight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+        self._slots.release()
+
+    def health(self):
+        report = {
+            "status": "ok",
+            "version": version,
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "concurrency": self.concurrency,
+            "cache": self.cache.stats(),
+            "coalescing": self.flight.stats(),
+            "github": default_rate_limiter().state(),
+        }
+        if self.pool is not None:
+            report["workers"] = self.pool.health()
+        return report
+
+    def server_close(self):
+        super().server_close()
+        remove_metrics_hook(self.metrics)
+        self.client.close()
+        if self.pool is not None:
+            disable_render_pool()
+
+
+def cmd_serve(args):
+    server = RenderServer(
+        (args.host, args.port),
+        concurrency=args.concurrency,
+        queue_size=args.queue,
+        backend=args.backend,
+        pool=args.pool,
+        quiet=args.quiet,
+        lock_dir=args.lock_dir,
+        timeout=args.timeout,
+        engines=args.engine or ["local"],
+        max_body=args.max_body,
+        max_rows=args.max_rows,
+    )
+    print(f"serving on http://{args.host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="d2png", description="2D data (list of dicts, csv like) to png")
+    parser.add_argument("--version", action="version", version=version)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("render", help="render data files to images")
+    p.add_argument("inputs", nargs="+", help="files, directories or glob patterns of .json/.csv/.ndjson")
+    p.add_argument("-o", "--output", help="output file for a single input, otherwise a directory")
+    p.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="parallel renders")
+    p.add_argument("-t", "--title", default="")
+    p.add_argument("--engine", default="local", help="local, github or a markdown backend")
+    p.add_argument("--backend", default="wkhtmltoimage", help="wkhtmltoimage, pillow or a rasterizer backend")
+    p.add_argument("--formatter", help="formatter backend")
+    p.add_argument("--theme", default="table", choices=sorted(THEMES))
+    p.add_argument("--format", default="png", choices=["png", "webp", "jpeg"])
+    p.add_argument("--optimize", action="store_true", help="recompress png output")
+    p.add_argument("--timeout", type=float, help="seconds allowed per file")
+    p.add_argument("-f", "--force", action="store_true", help="render even if the output is newer")
+    p.add_argument("-q", "--quiet", action="store_true")
+    p.set_defaults(func=cmd_render)
+
+    p = sub.add_parser("serve", help="run the http rendering service")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8080)
+    p.add_argument("-c", "--concurrency", type=int, default=os.cpu_count() or 1, help="parallel renders")
+    p.add_argument("--queue", type=int, default=64, help="requests allowed to wait for a render slot")
+    p.add_argument("--backend", default="wkhtmltoimage", help="wkhtmltoimage, pillow or a rasterizer backend")
+    p.add_argument("--pool", action="store_true", help="keep Pillow renders in resident worker processes")
+    p.add_argument("--lock-dir", help="coalesce identical renders with other servers using this directory")
+    p.add_argument("--timeout", type=float, help="seconds allowed per render, 504 after that")
+    p.add_argument(
+        "--engine", action="append", help="markdown engine requests may use, repeatable (default: local only)"
+    )
+    p.add_argument("--max-body", type=int, default=16 * 1024 * 1024, help="largest request body in bytes")
+    p.add_argument("--max-rows", type=int, default=100000, help="most rows per request")
+    p.add_argument("-q", "--quiet", action="store_true")
+    p.set_defaults(func=cmd_serve)
+
+    args = parser.parse_args(argv)
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -37,13 +37,16 @@ setup(
     name=name,  # Required
     version=get_version("d2_png.py".format(name)),  # Required
     # This is a one-line description or tagline of what your project does.
-    description="simple crontab implemented on thread executor pool",  # Required
+    description="2D data (list of dicts, csv like) to png",  # Required
     long_description=long_description,  # Optional
     long_description_content_type="text/markdown",  # Optional
     install_requires=install_requires,
+    # ImageFont.load_default(size) appeared in Pillow 10.1
+    extras_require={"async": ["aiohttp"], "pillow": ["Pillow>=10.1"]},
+    python_requires=">=3.10",
     py_modules=['d2_png'],
     entry_points={
-        "console_scripts": ["pycrontab=pycrontab.__main__:main"]
+        "console_scripts": ["d2png=d2_png:main"]
     },  # Optional
     url=gh_repo,  # Optional
     author="weaming",  # Optional
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench  # noqa: E402
+import d2_png  # noqa: E402
+
+# stands in for wkhtmltoimage: logs the run, sleeps, then writes the html it
+# was piped (or a fixed image) to the last argument, "-" being stdout
+STUB = """#!/bin/sh
+echo run >> "{log}"
+sleep {delay}
+for a in "$@"; do out="$a"; done
+if [ "$out" = "-" ]; then out=/dev/stdout; fi
+{body} > "$out"
+"""
+
+
+@pytest.fixture
+def wkhtmltoimage(tmp_path, monkeypatch):
+    """Point $WKHTMLTOIMAGE at a shell stand-in, returns install(delay=0, png=None) -> run log path"""
+
+    def install(delay=0, png=None):
+        log = tmp_path / "wkhtmltoimage.log"
+        log.write_text("")
+        body = f'{{ cat > /dev/null; cat "{png}"; }}' if png else "cat"
+        script = tmp_path / "wkhtmltoimage"
+        script.write_text(STUB.format(log=log, delay=delay, body=body))
+        script.chmod(0o755)
+        monkeypatch.setenv("WKHTMLTOIMAGE", str(script))
+        return log
+
+    return install
+
+
+@pytest.fixture
+def github(monkeypatch):
+    """The bench.py /markdown stand-in, served for this test with a fresh rate limiter"""
+    server = bench.start_stub(0)
+    monkeypatch.setattr(d2_png, "GITHUB_MARKDOWN_API", f"http://127.0.0.1:{server.server_port}/markdown")
+    monkeypatch.setattr(d2_png, "_rate_limiter", d2_png.GithubRateLimiter(token=""))
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,96 @@
+import asyncio
+import io
+import threading
+import time
+
+import pytest
+
+import d2_png
+
+ROWS = [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}]
+
+
+@pytest.fixture
+def out(tmp_path):
+    path = tmp_path / "out"
+    path.mkdir()
+    return path
+
+
+def test_rasterize_writes_stdout(wkhtmltoimage):
+    log = wkhtmltoimage()
+    assert b"<table>" in d2_png.csv2png(ROWS, timeout=5)
+    assert log.read_text().count("run") == 1
+
+
+def test_timeout_kills_wkhtmltoimage(wkhtmltoimage, out):
+    wkhtmltoimage(delay=10)
+    started = time.monotonic()
+    with pytest.raises(d2_png.DeadlineExceeded) as e:
+        d2_png.csv2png(ROWS, str(out / "t.png"), timeout=0.5)
+    assert time.monotonic() - started < 3
+    assert e.value.stage == "rasterize"
+    assert list(out.iterdir()) == []
+
+
+def test_cancel_kills_wkhtmltoimage(wkhtmltoimage, out):
+    wkhtmltoimage(delay=10)
+    cancel = d2_png.CancelToken()
+    threading.Timer(0.3, cancel.cancel).start()
+    started = time.monotonic()
+    with pytest.raises(d2_png.Cancelled):
+        d2_png.csv2png(ROWS, str(out / "t.png"), cancel=cancel)
+    assert time.monotonic() - started < 3
+    assert list(out.iterdir()) == []
+
+
+def test_cancelled_before_start(wkhtmltoimage, out):
+    log = wkhtmltoimage()
+    cancel = d2_png.CancelToken()
+    cancel.cancel()
+    with pytest.raises(d2_png.Cancelled):
+        d2_png.csv2png(ROWS, str(out / "t.png"), cancel=cancel)
+    assert log.read_text() == ""
+
+
+def test_stage_timeout(wkhtmltoimage, out):
+    wkhtmltoimage(delay=10)
+    with pytest.raises(d2_png.DeadlineExceeded) as e:
+        d2_png.csv2png(ROWS, str(out / "t.png"), timeout=30, stage_timeouts={"rasterize": 0.3})
+    assert e.value.stage == "rasterize"
+    assert list(out.iterdir()) == []
+
+
+def test_async_cancel_leaves_no_part(wkhtmltoimage, out):
+    wkhtmltoimage(delay=10)
+
+    async def main():
+        task = asyncio.ensure_future(d2_png.csv2png_async(ROWS, str(out / "t.png")))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    started = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - started < 3
+    assert list(out.iterdir()) == []
+
+
+def test_async_writes_file_objects(wkhtmltoimage):
+    wkhtmltoimage()
+    buf = io.BytesIO()
+    asyncio.run(d2_png.csv2png_async(ROWS, buf))
+    assert b"<table>" in buf.getvalue()
+
+
+def test_many_fails_only_late_jobs(wkhtmltoimage, out):
+    wkhtmltoimage(delay=1)
+    jobs = [
+        {"data": ROWS, "outfile": str(out / "slow.png"), "timeout": 0.3},
+        {"data": ROWS, "outfile": str(out / "ok.png"), "timeout": 10},
+    ]
+    results = {r.index: r for r in d2_png.csv2png_many(jobs)}
+    assert isinstance(results[0].error, d2_png.DeadlineExceeded)
+    assert results[1].error is None
+    assert [p.name for p in out.iterdir()] == ["ok.png"]
@@ -0,0 +1,133 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import d2_png
+
+
+def tables(count, rows=3):
+    return [d2_png.table_markdown([{"n": f"t{i}r{j}"} for j in range(rows)]) for i in range(count)]
+
+
+def test_post_github_many_splits_one_call(github):
+    html = d2_png.post_github_many(tables(20))
+    assert github.calls == 1
+    for i, part in enumerate(html):
+        assert part.count("<table>") == 1
+        assert f"t{i}r0" in part and f"t{i}r2" in part
+        assert "d2png-split" not in part
+
+
+def test_post_github_many_matches_single_calls(github):
+    texts = tables(5)
+    assert d2_png.post_github_many(texts) == [d2_png.post_github(t, "markdown", None) for t in texts]
+
+
+def test_post_github_many_halves_on_413(github):
+    texts = tables(16)
+    github.max_bytes = 4 * len(texts[0])
+    html = d2_png.post_github_many(texts)
+    assert github.calls > 4
+    for i, part in enumerate(html):
+        assert f"t{i}r0" in part and part.count("<table>") == 1
+
+
+def test_post_github_many_uses_cache(github, tmp_path):
+    cache = d2_png.MarkdownCache(directory=str(tmp_path))
+    texts = tables(4)
+    first = d2_png.post_github_many(texts, cache=cache)
+    calls = github.calls
+    assert d2_png.post_github_many(texts, cache=cache) == first
+    assert github.calls == calls
+
+
+def test_batch_jobs_keep_their_own_deadline(github, wkhtmltoimage):
+    wkhtmltoimage()
+    github.latency = 1
+    cancel = d2_png.CancelToken()
+    threading.Timer(0.2, cancel.cancel).start()
+    jobs = [
+        {"data": [{"a": 1}], "engine": "github", "timeout": 0.3},
+        {"data": [{"a": 2}], "engine": "github", "cancel": cancel},
+        {"data": [{"a": 3}], "engine": "github", "timeout": 10},
+    ]
+    started = time.monotonic()
+    results = {}
+    for r in d2_png.csv2png_many(jobs, batch=True):
+        results[r.index] = (r, time.monotonic() - started)
+    assert isinstance(results[0][0].error, d2_png.DeadlineExceeded)
+    assert isinstance(results[1][0].error, d2_png.Cancelled)
+    assert results[0][1] < 0.9 and results[1][1] < 0.9
+    assert results[2][0].error is None and b"<td>3</td>" in results[2][0].data
+
+
+class LimitedHandler(BaseHTTPRequestHandler):
+    """Answers with the (status, headers) queued on the server, then 200"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.calls += 1
+        status, headers = self.server.answers.pop(0) if self.server.answers else (200, {})
+        body = b"<p>ok</p>" if status == 200 else b"{}"
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, str(v))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def limited(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LimitedHandler)
+    server.daemon_threads = True
+    server.calls = 0
+    server.answers = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(d2_png, "GITHUB_MARKDOWN_API", f"http://127.0.0.1:{server.server_port}/markdown")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_waits_for_retry_after(limited):
+    limited.answers = [(403, {"Retry-After": 0.3})]
+    limiter = d2_png.GithubRateLimiter(token="")
+    started = time.monotonic()
+    assert d2_png.post_github("x", "markdown", None, limiter=limiter) == "<p>ok</p>"
+    assert time.monotonic() - started >= 0.3
+    assert limited.calls == 2
+    assert limiter.waited == pytest.approx(0.3)
+
+
+def test_waits_for_the_quota_reset(limited):
+    reset = time.time() + 0.5
+    limited.answers = [(200, {"X-RateLimit-Limit": 60, "X-RateLimit-Remaining": 0, "X-RateLimit-Reset": reset})]
+    limiter = d2_png.GithubRateLimiter(token="")
+    d2_png.post_github("x", "markdown", None, limiter=limiter)
+    d2_png.post_github("y", "markdown", None, limiter=limiter)
+    assert time.time() >= reset
+    assert limited.calls == 2
+
+
+def test_gives_up_past_max_wait(limited):
+    limited.answers = [(403, {"Retry-After": 60})]
+    limiter = d2_png.GithubRateLimiter(token="", max_wait=1)
+    started = time.monotonic()
+    with pytest.raises(d2_png.GithubApiError) as e:
+        d2_png.post_github("x", "markdown", None, limiter=limiter)
+    assert e.value.status == 403
+    assert time.monotonic() - started < 1
+
+
+def test_deadline_cuts_the_wait_short(limited):
+    limited.answers = [(429, {"Retry-After": 5})]
+    limiter = d2_png.GithubRateLimiter(token="")
+    with pytest.raises(d2_png.DeadlineExceeded):
+        with d2_png.deadline_scope(d2_png.Deadline(1)):
+            d2_png.post_github("x", "markdown", None, limiter=limiter)
@@ -0,0 +1,58 @@
+import pytest
+
+import d2_png
+
+pytest.importorskip("PIL")
+from PIL import Image, ImageChops  # noqa: E402
+
+
+def rows(count, wide=None):
+    data = [{"id": i, "name": f"row {i}", "note": "x" * (i % 7)} for i in range(count)]
+    if wide is not None:
+        data[wide]["note"] = "a much wider note than any before"
+    return data
+
+
+def same(a, b):
+    return a.size == b.size and ImageChops.difference(a, b).getbbox() is None
+
+
+def test_incremental_matches_full_render():
+    renderer = d2_png.IncrementalRenderer(block_rows=8, title="T")
+    data = rows(50)
+    assert same(renderer.render(data), d2_png.render_table_pil(data, title="T"))
+
+    data[20]["name"] = "new"
+    assert same(renderer.render(data), d2_png.render_table_pil(data, title="T"))
+    assert renderer.redrawn == 1
+
+
+def test_incremental_grows():
+    renderer = d2_png.IncrementalRenderer(block_rows=8)
+    for count in (10, 30, 45):
+        data = rows(count)
+        assert same(renderer.render(data), d2_png.render_table_pil(data))
+
+
+def test_incremental_falls_back_to_full_render():
+    renderer = d2_png.IncrementalRenderer(block_rows=8)
+    renderer.render(rows(40))
+    data = rows(40, wide=30)
+    assert same(renderer.render(data), d2_png.render_table_pil(data))
+    assert renderer.redrawn == 5
+
+    data = [dict(row, extra=1) for row in data]
+    assert same(renderer.render(data), d2_png.render_table_pil(data))
+
+
+def test_sheet_falls_back_to_one_run_per_table(wkhtmltoimage, tmp_path):
+    # a blank image has no marker bars to cut the sheet on
+    png = tmp_path / "blank.png"
+    Image.new("RGB", (40, 30), "white").save(png)
+    log = wkhtmltoimage(png=png)
+    jobs = [{"data": [{"a": i}]} for i in range(3)] + [{"data": [{"a": 3}], "outfile": str(tmp_path / "t.png")}]
+    results = d2_png.csv2png_sheet(jobs)
+    assert [r.error for r in results] == [None] * 4
+    assert all(r.data == png.read_bytes() for r in results[:3])
+    assert (tmp_path / "t.png").read_bytes() == png.read_bytes()
+    assert log.read_text().count("run") == 1 + 4
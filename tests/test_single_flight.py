@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import d2_png
+
+
+def slow(calls, value, delay=0.3):
+    calls.append(value)
+    time.sleep(delay)
+    return value
+
+
+def test_coalesces_concurrent_calls():
+    flight = d2_png.SingleFlight()
+    calls = []
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: flight.do("k", slow, calls, b"png"), range(8)))
+    assert results == [b"png"] * 8
+    assert calls == [b"png"]
+    assert (flight.runs, flight.coalesced) == (1, 7)
+
+
+def test_keys_run_separately():
+    flight = d2_png.SingleFlight()
+    calls = []
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda k: flight.do(k, slow, calls, k), ["a", "b", "a", "b"]))
+    assert results == ["a", "b", "a", "b"]
+    assert sorted(calls) == ["a", "b"]
+
+
+def test_waiters_get_the_exception():
+    flight = d2_png.SingleFlight()
+    started = threading.Event()
+
+    def boom():
+        started.set()
+        time.sleep(0.3)
+        raise ValueError("bad rows")
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(flight.do, "k", boom)
+        started.wait()
+        waiter = pool.submit(flight.do, "k", boom)
+        for fut in (leader, waiter):
+            with pytest.raises(ValueError):
+                fut.result()
+    assert flight.runs == 1
+
+
+def test_next_call_runs_again():
+    flight = d2_png.SingleFlight()
+    calls = []
+    flight.do("k", slow, calls, 1, 0)
+    flight.do("k", slow, calls, 2, 0)
+    assert calls == [1, 2]
+
+
+def test_lock_dir_coalesces_across_instances(tmp_path):
+    # two instances stand for two processes sharing the directory
+    flights = [d2_png.SingleFlight(lock_dir=str(tmp_path)) for _ in range(2)]
+    calls = []
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(flights[0].do, "k", slow, calls, b"png")
+        time.sleep(0.1)
+        second = pool.submit(flights[1].do, "k", slow, calls, b"png")
+        assert first.result() == second.result() == b"png"
+    assert calls == [b"png"]
+
+
+def test_server_locks_on_the_bare_digest(wkhtmltoimage, tmp_path):
+    import requests
+
+    wkhtmltoimage()
+    locks = tmp_path / "locks"
+    server = d2_png.RenderServer(("127.0.0.1", 0), lock_dir=str(locks), quiet=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        res = requests.post(f"http://127.0.0.1:{server.server_port}/render", json={"rows": [{"a": 1}]})
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert res.status_code == 200
+    digest = res.headers["ETag"].strip('"')
+    assert sorted(os.listdir(locks)) == [digest + ".lock", digest + ".result"]